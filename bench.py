@@ -0,0 +1,180 @@
+"""
+Benchmarks of the frame time of the client
+
+Every case builds a world with a random map, players and bullets and draws frames onto an image surface with the
+renderer. Like in a game, the own player and the other players move a little every frame and the bullets fly, so the
+caches that depend on the positions are updated as well. Results can be saved and compared to saved results to catch
+regressions.
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import cairo
+
+import renderer
+import tilemap
+
+# as sent by the server
+TILE_SIZE = 50
+CHUNK_SIZE = 32
+# fraction of the tiles that are walls
+WALL_DENSITY = .15
+
+
+class Case(NamedTuple):
+    map_size: int
+    players: int
+    bullets: int
+    width: int
+    height: int
+
+    @property
+    def name(self) -> str:
+        return f"map{self.map_size}-players{self.players}-bullets{self.bullets}-{self.width}x{self.height}"
+
+
+DEFAULT_CASE = Case(map_size=64, players=10, bullets=100, width=800, height=800)
+# the default case and variations of one parameter at a time
+CASES = [
+    DEFAULT_CASE,
+    DEFAULT_CASE._replace(map_size=16),
+    DEFAULT_CASE._replace(map_size=256),
+    DEFAULT_CASE._replace(map_size=1024),
+    DEFAULT_CASE._replace(players=1),
+    DEFAULT_CASE._replace(players=50),
+    DEFAULT_CASE._replace(bullets=0),
+    DEFAULT_CASE._replace(bullets=1000),
+    DEFAULT_CASE._replace(bullets=5000),
+    DEFAULT_CASE._replace(width=1920, height=1080),
+    DEFAULT_CASE._replace(width=3840, height=2160),
+]
+
+
+def random_map(size: int, rng: random.Random) -> tilemap.TileMap:
+    """
+    Return a map with walls around it and randomly placed walls inside.
+    """
+    rows = []
+    for y in range(size):
+        if y in (0, size - 1):
+            rows.append("#" * size)
+        else:
+            rows.append("#" + "".join("#" if rng.random() < WALL_DENSITY else " " for _ in range(size - 2)) + "#")
+    return tilemap.TileMap.from_rows(rows)
+
+
+def free_tile_center(map: tilemap.TileMap, rng: random.Random, near_x: float, near_y: float, distance: float):
+    while True:
+        x = rng.uniform(near_x - distance, near_x + distance)
+        y = rng.uniform(near_y - distance, near_y + distance)
+        tile_x = int(x // TILE_SIZE)
+        tile_y = int(y // TILE_SIZE)
+        if 0 <= tile_x < map.width and 0 <= tile_y < map.height and not tilemap.is_wall(map, tile_x, tile_y):
+            return (tile_x + .5) * TILE_SIZE, (tile_y + .5) * TILE_SIZE
+
+
+def build_world(case: Case, rng: random.Random) -> renderer.World:
+    world = renderer.World()
+    map = random_map(case.map_size, rng)
+    world.set_map(map, TILE_SIZE, CHUNK_SIZE)
+    world.player_uuid = "player"
+    center = case.map_size * TILE_SIZE / 2
+    world.player = world.players[world.player_uuid] = renderer.Player(
+        *free_tile_center(map, rng, center, center, center), 0, 1)
+    for i in range(case.players - 1):
+        x, y = free_tile_center(map, rng, world.player.x, world.player.y, case.width / 2)
+        world.players[f"other {i}"] = renderer.Player(x, y, rng.uniform(-math.pi, math.pi), rng.random())
+    return world
+
+
+def add_bullets(world: renderer.World, count: int, rng: random.Random) -> None:
+    while len(world.bullets) < count:
+        angle = rng.uniform(-math.pi, math.pi)
+        shooter = rng.choice(list(world.players))
+        player = world.players[shooter]
+        world.bullets.add(player.x, player.y, 500 * math.cos(angle), 500 * math.sin(angle), shooter)
+
+
+def run_case(case: Case, frames: int, warmup: int) -> Dict[str, float]:
+    """
+    Return the mean, median, 95th percentile and maximum frame time in milliseconds.
+    """
+    rng = random.Random(0)
+    world = build_world(case, rng)
+    surface = cairo.ImageSurface(cairo.Format.ARGB32, case.width, case.height)
+    # the players walk in small circles around their tile centers, so they never walk into walls
+    centers = {uuid: (player.x, player.y) for uuid, player in world.players.items()}
+    frame_times: List[float] = []
+    for frame in range(warmup + frames):
+        add_bullets(world, case.bullets, rng)
+        for i, (uuid, (x, y)) in enumerate(centers.items()):
+            angle = (frame + i) / 10
+            player = world.players[uuid]
+            player.previous_x, player.previous_y = player.x, player.y
+            player.x = x + 5 * math.cos(angle)
+            player.y = y + 5 * math.sin(angle)
+            player.rotation = angle
+
+        start_time = time.perf_counter()
+        world.bullets.animate(1 / 60, world.players, world.map, world.tile_size)
+        renderer.draw(cairo.Context(surface), world, case.width, case.height, .5)
+        surface.flush()
+        if frame >= warmup:
+            frame_times.append(time.perf_counter() - start_time)
+
+    frame_times.sort()
+    return {
+        "mean": sum(frame_times) / len(frame_times) * 1000,
+        "p50": frame_times[len(frame_times) // 2] * 1000,
+        "p95": frame_times[min(len(frame_times) - 1, round(.95 * len(frame_times)))] * 1000,
+        "max": frame_times[-1] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmark the frame time of the shooter2d client")
+    parser.add_argument("--cases", help="only run the cases whose name contains this")
+    parser.add_argument("--frames", type=int, default=200, help="frames measured per case (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=20, help="frames drawn before measuring (default: %(default)s)")
+    parser.add_argument("--output", help="write the results as JSON to this file, e.g. to use them as a baseline")
+    parser.add_argument("--baseline", help="compare the results to those in this file")
+    parser.add_argument("--tolerance", type=float, default=.2,
+                        help="fraction the median frame time may exceed the baseline by (default: %(default)s)")
+    args = parser.parse_args()
+
+    baseline: Optional[Dict[str, Dict[str, float]]] = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'case':48} {'mean':>8} {'p50':>8} {'p95':>8} {'max':>8} ms")
+    for case in CASES:
+        if args.cases and args.cases not in case.name:
+            continue
+        result = results[case.name] = run_case(case, args.frames, args.warmup)
+        line = f"{case.name:48} {result['mean']:8.2f} {result['p50']:8.2f} {result['p95']:8.2f} {result['max']:8.2f}"
+        if baseline is not None and case.name in baseline:
+            change = result["p50"] / baseline[case.name]["p50"] - 1
+            line += f"  p50 {change:+.0%} against the baseline"
+            if change > args.tolerance:
+                regressions.append(case.name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"{len(regressions)} cases are more than {args.tolerance:.0%} slower than the baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
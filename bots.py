@@ -0,0 +1,397 @@
+"""
+Headless bot swarm to load test the server
+
+Every bot opens its own connection, speaks the same protocol as the client, walks through the corridors of the map
+and shoots in random directions. The swarm reports the message and byte rates, the relay latency (from a bot
+sending a position until another bot sees it in a snapshot) and the CPU usage of the server process.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import protocol
+import tilemap
+
+MAX_SPEED = 70
+# seconds between two registrations of the datagram channel until the server answers
+REGISTER_INTERVAL = .2
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.received_messages = 0
+        self.received_bytes = 0
+        self.latencies: List[float] = []
+
+    def reset(self) -> None:
+        self.__init__()
+
+
+class Swarm:
+    def __init__(self) -> None:
+        self.bots: List[Bot] = []
+        self.stats = Stats()
+        # send times of the positions by (player id, quantized x, quantized y)
+        self.sent_positions: Dict[Tuple[int, int, int], float] = {}
+
+    def forget_positions(self, max_age: float) -> None:
+        oldest = time.perf_counter() - max_age
+        self.sent_positions = {key: sent_time for key, sent_time in self.sent_positions.items() if sent_time > oldest}
+
+
+class BotDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bot: "Bot", token: str) -> None:
+        self.bot = bot
+        self.token = token
+        self.transport: asyncio.DatagramTransport = None
+        self.codec = protocol.DatagramCodec()
+        self.sent_sequence = 0
+        self.received_sequence = 0
+        self.registered = False
+
+    def send(self, **message) -> None:
+        self.sent_sequence += 1
+        data = self.codec.encode(self.sent_sequence, message)
+        self.transport.sendto(data)
+        self.bot.swarm.stats.sent_messages += 1
+        self.bot.swarm.stats.sent_bytes += len(data)
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.bot.datagram_protocol = self
+        self.register()
+
+    def register(self) -> None:
+        if self.registered or self.bot.closed:
+            return
+        self.send(type="register", token=self.token)
+        asyncio.get_event_loop().call_later(REGISTER_INTERVAL, self.register)
+
+    def datagram_received(self, data: bytes, address) -> None:
+        self.bot.swarm.stats.received_bytes += len(data)
+        sequence, message = self.codec.decode(data)
+        if sequence <= self.received_sequence:
+            return
+        self.received_sequence = sequence
+        if message["type"] == "registered":
+            self.registered = True
+        else:
+            self.bot.dispatch_message(message)
+
+
+class Bot(asyncio.Protocol):
+    def __init__(self, swarm: Swarm, json_only: bool, udp: bool) -> None:
+        self.swarm = swarm
+        self.json_only = json_only
+        self.udp = udp
+        self.datagram_protocol: Optional[BotDatagramProtocol] = None
+        self.buffer = protocol.FrameBuffer()
+        self.transport: asyncio.WriteTransport = None
+        self.encoder = protocol.JsonCodec()
+        self.decoder = protocol.JsonCodec()
+        self.states: Dict[int, protocol.WorldState] = {0: {}}
+        self.tick = 0
+        self.map: tilemap.TileMap = None
+        self.tile_size: int = None
+        self.chunk_size: int = None
+        self.uuid: str = None
+        self.id: int = None
+        self.x = 0.
+        self.y = 0.
+        self.rotation = 0.
+        self.input_sequence = 0
+        self.target: Optional[Tuple[int, int]] = None
+        self.previous_tile: Optional[Tuple[int, int]] = None
+        self.closed = False
+
+    def send(self, **message) -> None:
+        data = self.encoder.encode(message)
+        self.transport.write(data)
+        self.swarm.stats.sent_messages += 1
+        self.swarm.stats.sent_bytes += len(data)
+
+    def send_unreliable(self, **message) -> None:
+        if self.datagram_protocol is not None and self.datagram_protocol.registered:
+            self.datagram_protocol.send(**message)
+        else:
+            self.send(**message)
+
+    def connection_made(self, transport: asyncio.WriteTransport) -> None:
+        self.transport = transport
+        formats = [protocol.JsonCodec.name] if self.json_only else [protocol.BinaryCodec.name, protocol.JsonCodec.name]
+        self.send(type="hello", formats=formats, udp=self.udp)
+
+    def connection_lost(self, exc) -> None:
+        self.closed = True
+        if self.datagram_protocol is not None:
+            self.datagram_protocol.transport.close()
+
+    def data_received(self, data: bytes) -> None:
+        self.swarm.stats.received_bytes += len(data)
+        self.buffer.feed(data)
+        while True:
+            frame = self.decoder.next_frame(self.buffer)
+            if frame is None:
+                break
+            self.dispatch_message(self.decoder.decode(frame))
+
+    def dispatch_message(self, message: dict) -> None:
+        self.swarm.stats.received_messages += 1
+        handler = getattr(self, f"handle_{message.pop('type')}", None)
+        if handler:
+            handler(**message)
+
+    def handle_format(self, format):
+        self.decoder = protocol.CODECS[format]()
+        self.send(type="format", format=format)
+        self.encoder = protocol.CODECS[format]()
+
+    def handle_world(self, width, height, tile_size, chunk_size, tick_rate):
+        self.map = tilemap.TileMap(width, height)
+        self.tile_size = tile_size
+        self.chunk_size = chunk_size
+
+    def handle_chunk(self, x, y, tiles):
+        self.map.set_chunk(x, y, self.chunk_size, base64.b64decode(tiles))
+
+    def handle_uuid(self, uuid):
+        self.uuid = uuid
+
+    def handle_udp(self, port, token):
+        host = self.transport.get_extra_info("peername")[0]
+        loop = asyncio.get_event_loop()
+        loop.create_task(loop.create_datagram_endpoint(
+            lambda: BotDatagramProtocol(self, token), remote_addr=(host, port)))
+
+    def handle_snapshot(self, tick, baseline, input, joined, removed, players):
+        if tick <= self.tick or baseline not in self.states:
+            # a late datagram
+            return
+        state = protocol.apply_delta(self.states[baseline], joined, removed, players)
+        self.states[tick] = state
+        for old_tick in [old_tick for old_tick in self.states if old_tick < baseline]:
+            del self.states[old_tick]
+        self.tick = tick
+        self.send_unreliable(type="ack", tick=tick)
+
+        now = time.perf_counter()
+        for player_id, mask, *_ in players:
+            if state[player_id][0] == self.uuid:
+                if self.id is None:
+                    # start where the server spawned us
+                    self.x, self.y, *_ = protocol.dequantize_player(state[player_id])
+                self.id = player_id
+            elif mask & 0b11:
+                _, x, y, *_ = state[player_id]
+                sent_time = self.swarm.sent_positions.get((player_id, x, y))
+                if sent_time is not None:
+                    self.swarm.stats.latencies.append(now - sent_time)
+
+    def move(self, time_elapsed: float) -> None:
+        """
+        Walk from tile to tile through the free tiles of the map.
+        """
+        if not self.map or self.id is None:
+            return
+        tile = (int(self.x // self.tile_size), int(self.y // self.tile_size))
+        if self.target is None or tile == self.target and self.close_to_center(self.target):
+            neighbours = [
+                (tile[0] + dx, tile[1] + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                if not tilemap.is_wall(self.map, tile[0] + dx, tile[1] + dy)
+            ]
+            if len(neighbours) > 1 and self.previous_tile in neighbours:
+                # don't walk back unless it is a dead end
+                neighbours.remove(self.previous_tile)
+            self.previous_tile = tile
+            self.target = random.choice(neighbours) if neighbours else tile
+        target_x = (self.target[0] + .5) * self.tile_size
+        target_y = (self.target[1] + .5) * self.tile_size
+        dx = target_x - self.x
+        dy = target_y - self.y
+        distance = (dx**2 + dy**2)**.5
+        step = min(distance, time_elapsed * MAX_SPEED)
+        if distance:
+            self.x += step * dx / distance
+            self.y += step * dy / distance
+            self.rotation = math.atan2(dy, dx)
+
+    def close_to_center(self, tile: Tuple[int, int]) -> bool:
+        return abs(self.x - (tile[0] + .5) * self.tile_size) < 1 and abs(self.y - (tile[1] + .5) * self.tile_size) < 1
+
+    def send_position(self) -> None:
+        if self.id is None:
+            # wait for the spawn position
+            return
+        self.input_sequence += 1
+        self.send_unreliable(type="position", x=self.x, y=self.y, rotation=self.rotation, sequence=self.input_sequence)
+        _, x, y, *_ = protocol.quantize_player(self.uuid, self.x, self.y, self.rotation, 0)
+        self.swarm.sent_positions[self.id, x, y] = time.perf_counter()
+
+    def shoot(self) -> None:
+        self.send(type="shoot", rotation=random.uniform(-math.pi, math.pi), tick=self.tick)
+
+
+class CpuMonitor:
+    """
+    CPU usage of another process from /proc, only available on Linux.
+    """
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.last_cpu_time = self.cpu_time()
+        self.last_time = time.perf_counter()
+
+    def cpu_time(self) -> float:
+        with open(f"/proc/{self.pid}/stat") as f:
+            # the command may contain spaces, the fields after it are space separated
+            fields = f.read().rsplit(")", 1)[1].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+    def usage(self) -> float:
+        """
+        Return the used CPU time per wall clock time since the last call.
+        """
+        cpu_time = self.cpu_time()
+        now = time.perf_counter()
+        usage = (cpu_time - self.last_cpu_time) / (now - self.last_time)
+        self.last_cpu_time = cpu_time
+        self.last_time = now
+        return usage
+
+
+def percentile_ms(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+
+def summarize(swarm: Swarm, duration: float, cpu_monitor: Optional[CpuMonitor]) -> dict:
+    stats = swarm.stats
+    return {
+        "bots": sum(not bot.closed for bot in swarm.bots),
+        "sent_messages_per_second": stats.sent_messages / duration,
+        "sent_bytes_per_second": stats.sent_bytes / duration,
+        "received_messages_per_second": stats.received_messages / duration,
+        "received_bytes_per_second": stats.received_bytes / duration,
+        "latency_samples": len(stats.latencies),
+        "latency_p50_ms": percentile_ms(stats.latencies, .5),
+        "latency_p90_ms": percentile_ms(stats.latencies, .9),
+        "latency_p99_ms": percentile_ms(stats.latencies, .99),
+        "server_cpu": cpu_monitor.usage() if cpu_monitor else None,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    def milliseconds(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.1f}"
+
+    cpu = "-" if summary["server_cpu"] is None else f"{summary['server_cpu'] * 100:.0f}%"
+    print(
+        f"bots {summary['bots']:4.0f}  "
+        f"up {summary['sent_messages_per_second']:8.0f} msg/s {summary['sent_bytes_per_second'] / 1024:8.1f} KiB/s  "
+        f"down {summary['received_messages_per_second']:8.0f} msg/s "
+        f"{summary['received_bytes_per_second'] / 1024:8.1f} KiB/s  "
+        f"latency p50 {milliseconds(summary['latency_p50_ms'])} "
+        f"p90 {milliseconds(summary['latency_p90_ms'])} "
+        f"p99 {milliseconds(summary['latency_p99_ms'])} ms  "
+        f"server cpu {cpu}"
+    )
+
+
+async def run_bot(bot: Bot, args: argparse.Namespace) -> None:
+    interval = 1 / args.send_rate
+    last_time = time.perf_counter()
+    while not bot.closed:
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        bot.move(now - last_time)
+        last_time = now
+        bot.send_position()
+        if random.random() < args.fire_rate * interval:
+            bot.shoot()
+
+
+async def run_swarm(args: argparse.Namespace) -> List[dict]:
+    loop = asyncio.get_event_loop()
+    swarm = Swarm()
+    cpu_monitor = CpuMonitor(args.server_pid) if args.server_pid else None
+    tasks = []
+    for _ in range(args.bots):
+        _, bot = await loop.create_connection(lambda: Bot(swarm, args.json_only, args.udp), args.host, args.port)
+        swarm.bots.append(bot)
+        tasks.append(loop.create_task(run_bot(bot, args)))
+        if args.ramp_up:
+            await asyncio.sleep(args.ramp_up / args.bots)
+
+    # only measure once all bots are connected
+    summaries = []
+    swarm.stats.reset()
+    if cpu_monitor:
+        cpu_monitor.usage()
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < args.duration:
+        interval_start = time.perf_counter()
+        await asyncio.sleep(min(args.interval, args.duration - (interval_start - start_time)))
+        summary = summarize(swarm, time.perf_counter() - interval_start, cpu_monitor)
+        print_summary(summary)
+        summaries.append(summary)
+        swarm.stats.reset()
+        swarm.forget_positions(5)
+
+    for bot in swarm.bots:
+        bot.transport.close()
+    for task in tasks:
+        task.cancel()
+    return summaries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="load test the shooter2d server with headless bots")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5661)
+    parser.add_argument("--bots", type=int, default=10, help="number of bots (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure (default: %(default)s)")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between reports (default: %(default)s)")
+    parser.add_argument("--ramp-up", type=float, default=0,
+                        help="seconds over which the bots connect (default: all at once)")
+    parser.add_argument("--send-rate", type=float, default=30,
+                        help="positions per second sent by each bot (default: %(default)s)")
+    parser.add_argument("--fire-rate", type=float, default=1,
+                        help="shots per second fired by each bot (default: %(default)s)")
+    parser.add_argument("--json-only", action="store_true", help="do not negotiate the binary wire format")
+    parser.add_argument("--udp", action="store_true",
+                        help="send positions and receive snapshots over UDP if the server offers it")
+    parser.add_argument("--server-pid", type=int, help="pid of the server process to report its CPU usage")
+    parser.add_argument("--report", help="append the averaged results as a JSON line to this file")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    try:
+        summaries = loop.run_until_complete(run_swarm(args))
+    except KeyboardInterrupt:
+        return
+    finally:
+        loop.close()
+
+    if summaries:
+        total = {key: None if any(summary[key] is None for summary in summaries)
+                 else sum(summary[key] for summary in summaries) / len(summaries)
+                 for key in summaries[0]}
+        print("average:")
+        print_summary(total)
+        if args.report:
+            with open(args.report, "a") as f:
+                f.write(json.dumps({"time": time.time(), "args": vars(args), **total}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
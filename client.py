@@ -1,69 +1,47 @@
 """
 Game
 """
+import argparse
 import asyncio
-import contextlib
-import itertools
-import json
+import base64
 import math
-import time
-from typing import List, Dict
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
 
 import cairo
 import gbulb
 import gi
 
+import profiler
+import protocol
+import renderer
+import tilemap
+
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk, GLib
 
 gbulb.install(gtk=True)
 loop = asyncio.get_event_loop()
 
-
-@contextlib.contextmanager
-def save_context(cr: cairo.Context) -> cairo.Context:
-    cr.save()
-    yield
-    cr.restore()
-
-
-class Rectangle:
-    def __init__(self, left: float, right: float, top: float, bottom: float) -> None:
-        self.left = left
-        self.right = right
-        self.top = top
-        self.bottom = bottom
-        self.width = right - left
-        self.height = bottom - top
-        self.x = left + self.width / 2
-        self.y = top + self.height / 2
-
-
-class Circle:
-    def __init__(self, x: float, y: float, radius: float) -> None:
-        self.x = x
-        self.y = y
-        self.radius = radius
-
-
-class Player:
-    def __init__(self, x: float, y: float, rotation: float, health: float) -> None:
-        self.x = x
-        self.y = y
-        self.rotation = rotation
-        self.health = health
-
-
-class Bullet:
-    def __init__(self, x: float, y: float, vx: float, vy: float) -> None:
-        self.x = x
-        self.y = y
-        self.vx = vx
-        self.vy = vy
-
-    def animate(self, time_elapsed: float) -> None:
-        self.x += time_elapsed * self.vx
-        self.y += time_elapsed * self.vy
+# seconds between two registrations of the datagram channel until the server answers
+REGISTER_INTERVAL = .2
+# simulation steps per second, frames are drawn between the last two steps
+SIMULATION_RATE = 60
+# steps simulated at most per frame, after a longer pause the simulation skips time instead of catching up
+MAX_STEPS_PER_FRAME = 5
+# keys that change the world while they are pressed
+SIMULATED_KEYS = {"a", "d", "w", "s", "Up", "Down"}
+# seconds other players are shown behind the newest snapshot, so there is usually a newer one to move towards
+INTERPOLATION_DELAY = .1
+# seconds the estimated delay of the snapshots grows with every snapshot, so it follows a growing latency
+CLOCK_RELAXATION = .001
+# positions sent that were not applied by the server yet, older ones are dropped
+MAX_PENDING_INPUTS = 256
+# smallest changes of the own player that are sent, in pixels and radians
+POSITION_THRESHOLD = 1 / protocol.POSITION_SCALE
+ROTATION_THRESHOLD = math.tau / 1024
+# same as on the server
+PLAYER_RADIUS = 10
 
 
 class ControlSettings:
@@ -74,241 +52,41 @@ class ControlSettings:
 class WindowState:
     def __init__(self):
         self.pressed_keys = set()
-        self.tick_time = time.perf_counter()
+        # id of the tick callback of the frame clock while the simulation runs
+        self.tick_callback: int = None
+        # frame clock time of the last frame in seconds, None until the first frame after the simulation started
+        self.frame_time: float = None
+        # simulated time not yet covered by a step
+        self.accumulator = 0.
+        # fraction of the step after the last one that the current frame shows
+        self.interpolation = 1.
         self.pointer_x = 0
         self.pointer_y = 0
+        # whether the timings of the frame profiler are shown over the view
+        self.show_profiler = False
+        # size of the view in pixels, the server sends the chunks of the map it covers
+        self.view_size: Tuple[int, int] = None
 
 
-class World:
-    def __init__(self):
-        self.map: List[str] = None
-        self.map_height: int = None
-        self.map_width: int = None
-        self.player_uuid: str = None
-        self.player: Player = None
-        self.max_speed = 70
-        self.bullets: List[Bullet] = []
-        self.players: Dict[str, Player] = {}
+def view_rectangle(widget: Gtk.Widget) -> renderer.Rectangle:
+    allocation = widget.get_allocation()
+    return renderer.view_rectangle(world, allocation.width, allocation.height, window_state.interpolation)
 
 
 def draw(widget: Gtk.Widget, cr: cairo.Context):
-    if not world.map:
-        return
-
-    player_x = world.player.x
-    player_y = world.player.y
-
     allocation = widget.get_allocation()
-    tile_width = allocation.width / world.map_width
-    tile_height = allocation.height / world.map_height
-
-    # clear drawing
-    cr.set_source_rgb(1, 1, 1)
-    cr.paint()
-
-    # draw shadow
-    shadow_surface = cairo.ImageSurface(cairo.Format.ARGB32, allocation.width, allocation.height)
-    scr = cairo.Context(shadow_surface)
-    scr.set_line_width(1)
-    scr.set_source_rgb(0, 0, 0)
-    for y, row in enumerate(world.map):
-        for x, tile in enumerate(row):
-            if tile == "#":
-                left = x * tile_width
-                top = y * tile_height
-                right = left + tile_width
-                bottom = top + tile_height
-                shadow_points = []
-                for dest_x, dest_y in itertools.product([left, right], [top, bottom]):
-                    other_x = {left: right, right: left}[dest_x]
-                    other_y = {top: bottom, bottom: top}[dest_y]
-                    if line_goes_through_border(player_x, player_y, dest_x, dest_y, other_x, top, bottom) \
-                            or line_goes_through_border(player_y, player_x, dest_y, dest_x, other_y, left, right):
-                        continue
-                    shadow_points.append((dest_x, dest_y))
-                if len(shadow_points) == 3:
-                    for i in range(len(shadow_points)):
-                        if shadow_points[i] == (shadow_points[(i - 1) % 3][0], shadow_points[(i + 1) % 3][1]) \
-                                or shadow_points[i] == (shadow_points[(i + 1) % 3][0], shadow_points[(i - 1) % 3][1]):
-                            del shadow_points[i]
-                            break
-                elif len(shadow_points) == 4:
-                    continue
-                for i, shadow_point in enumerate(extend_shadow_points(shadow_points, allocation)):
-                    if i == 0:
-                        scr.move_to(*shadow_point)
-                    else:
-                        scr.line_to(*shadow_point)
-                scr.fill()
-    cr.set_source_surface(shadow_surface)
-    cr.mask(cairo.SolidPattern(0, 0, 0, .6))
-    cr.fill()
-
-    # draw tiles
-    cr.set_line_width(1)
-    for y, row in enumerate(world.map):
-        for x, tile in enumerate(row):
-            if tile == "#":
-                cr.set_source_rgb(.9, 0, 0)
-                cr.rectangle(x * tile_width, y * tile_height, tile_width, tile_height)
-                cr.fill_preserve()
-                cr.set_source_rgba(0, 0, 0)
-                cr.stroke()
-
-    for player in world.players.values():
-        collides = False
-        for y, row in enumerate(world.map):
-            for x, tile in enumerate(row):
-                if tile == "#":
-                    left = x * tile_width
-                    top = y * tile_height
-                    right = left + tile_width
-                    bottom = top + tile_height
-                    if collision_rect_line(
-                            Rectangle(left, right, top, bottom),
-                            player_x, player_y, player.x, player.y):
-                        collides = True
-                        break
-            if collides:
-                break
-        if not collides:
-            draw_player(cr, player)
-
-    draw_player(cr, Player(player_x, player_y, world.player.rotation, world.player.health))
-
-    for bullet in world.bullets:
-        draw_bullet(cr, bullet)
-
-
-def extend_shadow_points(shadow_points, allocation):
-    yield shadow_points[0]
-
-    dx = shadow_points[0][0] - world.player.x or 1e-10
-    dy = shadow_points[0][1] - world.player.y or 1e-10
-    m = min([i for i in [
-        (-world.player.x) / dx,
-        (allocation.width - world.player.x) / dx,
-        (-world.player.y) / dy,
-        (allocation.height - world.player.y) / dy,
-    ] if i > 0])
-    extra1_x = world.player.x + m * dx
-    extra1_y = world.player.y + m * dy
-
-    dx = shadow_points[1][0] - world.player.x or 1e-10
-    dy = shadow_points[1][1] - world.player.y or 1e-10
-    m = min([i for i in [
-        (-world.player.x) / dx,
-        (allocation.width - world.player.x) / dx,
-        (-world.player.y) / dy,
-        (allocation.height - world.player.y) / dy,
-    ] if i > 0])
-    extra2_x = world.player.x + m * dx
-    extra2_y = world.player.y + m * dy
-
-    yield extra1_x, extra1_y
-
-    extra3_x = None
-    extra3_y = None
-    if extra1_x < 1e-6 or extra1_x > allocation.width - 1e-6:
-        extra3_x = extra1_x
-    else:
-        extra3_y = extra1_y
-    if extra2_x < 1e-6 or extra2_x > allocation.width - 1e-6:
-        if extra3_x is None:
-            yield extra2_x, extra3_y
-        elif abs(extra2_x - extra3_x) > 1e-6:
-            yield extra3_x, 0 if dy < 0 else allocation.height
-            yield extra2_x, 0 if dy < 0 else allocation.height
-    else:
-        if extra3_y is None:
-            yield extra3_x, extra2_y
-        elif abs(extra2_y - extra3_y) > 1e-6:
-            yield 0 if dx < 0 else allocation.width, extra3_y
-            yield 0 if dx < 0 else allocation.width, extra2_y
+    renderer.draw(cr, world, allocation.width, allocation.height, window_state.interpolation, frame_profiler)
+    frame_profiler.end_frame()
+    if window_state.show_profiler:
+        renderer.draw_overlay(cr, frame_profiler.summary_lines())
 
-    yield extra2_x, extra2_y
 
-    yield shadow_points[1]
-
-
-def line_goes_through_border(pos1, pos2, dest1, dest2, border, lower, upper):
-    """
-    Test if the line from (pos1, pos2) to (dest1, dest2) goes through the border between lower and upper.
-    """
-    try:
-        m = (border - pos1) / (dest1 - pos1)
-    except ZeroDivisionError:
-        return False
-    wall_closer = 0 < m < 1
-    through_wall = lower <= pos2 + m * (dest2 - pos2) <= upper
-    return wall_closer and through_wall
-
-
-def collision_rect_line(rect: Rectangle, start_x, start_y, end_x, end_y) -> bool:
-    if line_goes_through_border(start_x, start_y, end_x, end_y, rect.left, rect.top, rect.bottom) \
-            or line_goes_through_border(start_x, start_y, end_x, end_y, rect.right, rect.top, rect.bottom) \
-            or line_goes_through_border(start_y, start_x, end_y, end_x, rect.top, rect.left, rect.right) \
-            or line_goes_through_border(start_y, start_x, end_y, end_x, rect.bottom, rect.left, rect.right):
-        return True
-    return False
-
-
-def collision_rect_circle(rect: Rectangle, circle: Circle) -> bool:
-    dist_x = abs(circle.x - rect.x)
-    dist_y = abs(circle.y - rect.y)
-
-    if dist_x > rect.width / 2 + circle.radius:
-        return False
-    if dist_y > rect.height / 2 + circle.radius:
-        return False
-
-    if dist_x <= rect.width / 2:
-        return True
-    if dist_y <= rect.height / 2:
-        return True
-
-    corner_dist_sq = (dist_x - rect.width / 2)**2 + (dist_y - rect.height / 2)**2
-
-    return corner_dist_sq <= circle.radius**2
-
-
-def draw_player(cr: cairo.Context, player: Player) -> None:
-    with save_context(cr):
-        cr.translate(player.x, player.y)
-
-        with save_context(cr):
-            cr.rotate(player.rotation)
-
-            # draw player
-            cr.set_source_rgb(0, 0, 0)
-            cr.arc(0, 0, 10, 0, math.tau)
-            cr.fill()
-
-            # draw arms
-            cr.move_to(2, -10)
-            cr.rel_line_to(12, 0)
-            cr.move_to(2, 10)
-            cr.rel_line_to(12, 0)
-            cr.stroke()
-
-        # draw health
-        cr.set_source_rgb(1, 1, 1)
-        cr.rectangle(-20, -35, 40, 8)
-        cr.fill()
-        # cr.set_source_rgb(.1, .9, .2)
-        cr.set_source_rgb(2 * (1 - player.health), 2 * player.health, 0)
-        cr.rectangle(-20, -35, 40 * player.health, 8)
-        cr.fill()
-        cr.set_line_width(1)
-        cr.set_source_rgb(0, 0, 0)
-        cr.rectangle(-20, -35, 40, 8)
-        cr.stroke()
-
-
-def draw_bullet(cr: cairo.Context, bullet: Bullet) -> None:
-    cr.set_source_rgb(.2, .2, .2)
-    cr.arc(bullet.x, bullet.y, 1, 0, math.tau)
-    cr.fill()
+def resize(widget: Gtk.Widget, allocation: Gdk.Rectangle):
+    view_size = (allocation.width, allocation.height)
+    if view_size != window_state.view_size:
+        window_state.view_size = view_size
+        if client_protocol is not None:
+            client_protocol.send_view()
 
 
 def mouse_motion(widget: Gtk.Widget, event: Gdk.EventMotion):
@@ -316,28 +94,53 @@ def mouse_motion(widget: Gtk.Widget, event: Gdk.EventMotion):
     # world.player.y = round(event.y)
     window_state.pointer_x = event.x
     window_state.pointer_y = event.y
-    world.player.rotation = math.atan2(window_state.pointer_y - world.player.y, window_state.pointer_x - world.player.x)
+    view = view_rectangle(widget)
+    world.player.rotation = math.atan2(
+        view.top + window_state.pointer_y - world.player.y, view.left + window_state.pointer_x - world.player.x)
     widget.queue_draw()
-    client_protocol.send(type="position", x=world.player.x, y=world.player.y, rotation=world.player.rotation)
+    client_protocol.send_position()
 
 
 def press_button(widget: Gtk.Widget, event: Gdk.EventButton):
     if event.type == Gdk.EventType.BUTTON_PRESS:
-        dx = event.x - world.player.x
-        dy = event.y - world.player.y
+        view = view_rectangle(drawingarea)
+        dx = view.left + event.x - world.player.x
+        dy = view.top + event.y - world.player.y
         norm = (dx**2 + dy**2)**.5
-        world.bullets.append(Bullet(world.player.x, world.player.y, 500 * dx / norm, 500 * dy / norm))
+        world.bullets.add(world.player.x, world.player.y, 500 * dx / norm, 500 * dy / norm, world.player_uuid)
+        start_simulation()
+        # the server rewinds the shot to the tick we are showing the other players at
+        tick = round(render_time() * world.tick_rate) if world.clock_offset is not None else client_protocol.tick
+        client_protocol.send(type="shoot", rotation=math.atan2(dy, dx), tick=tick)
     return True
 
 
 def press_key(widget: Gtk.Widget, event: Gdk.EventKey):
-    window_state.pressed_keys.add(Gdk.keyval_name(Gdk.keyval_to_lower(event.keyval)))
-    tick()
+    key = Gdk.keyval_name(Gdk.keyval_to_lower(event.keyval))
+    if key == "F3":
+        toggle_profiler()
+    elif key == "F4":
+        toggle_capture()
+    window_state.pressed_keys.add(key)
+    start_simulation()
+
+
+def toggle_profiler() -> None:
+    window_state.show_profiler = not window_state.show_profiler
+    frame_profiler.enable(window_state.show_profiler)
+    drawingarea.queue_draw()
+
+
+def toggle_capture() -> None:
+    if frame_profiler.capture is None:
+        frame_profiler.start_capture()
+    else:
+        frame_profiler.stop_capture()
+    drawingarea.queue_draw()
 
 
 def release_key(widget: Gtk.Widget, event: Gdk.EventKey):
     window_state.pressed_keys.discard(Gdk.keyval_name(Gdk.keyval_to_lower(event.keyval)))
-    tick()
 
 
 def handle_keys(time_elapsed):
@@ -358,40 +161,16 @@ def handle_keys(time_elapsed):
             sin = math.sin(world.player.rotation + math.pi / 2)
             vx, vy = cos * vx - sin * vy, sin * vx + cos * vy
 
-        norm = (vx**2 + vy**2)**.5
-        new_pos_x = world.player.x + time_elapsed * speed * vx / norm
-        new_pos_y = world.player.y + time_elapsed * speed * vy / norm
-
-        would_collide = False
-        allocation = drawingarea.get_allocation()
-        tile_width = allocation.width / world.map_width
-        tile_height = allocation.height / world.map_height
-        tile_x = int(world.player.x / tile_width)
-        tile_y = int(world.player.y / tile_height)
-        tile_x_lower = max(0, tile_x - 1)
-        tile_x_upper = min(world.map_width, tile_x + 2)
-        tile_y_lower = max(0, tile_y - 1)
-        tile_y_upper = min(world.map_height, tile_y + 2)
-        for y, row in enumerate(world.map[tile_y_lower:tile_y_upper], start=tile_y_lower):
-            for x, tile in enumerate(row[tile_x_lower:tile_x_upper], start=tile_x_lower):
-                if tile == "#":
-                    left = x * tile_width
-                    top = y * tile_height
-                    right = left + tile_width
-                    bottom = top + tile_height
-                    if collision_rect_circle(
-                            Rectangle(left, right, top, bottom),
-                            Circle(new_pos_x, new_pos_y, 10)):
-                        would_collide = True
-                        break
-            if would_collide:
-                break
-
-        if not would_collide:
-            world.player.x = new_pos_x
-            world.player.y = new_pos_y
+        # slide along the walls in tile coordinates
+        distance = time_elapsed * speed / (vx**2 + vy**2)**.5 / world.tile_size
+        x, y, _ = tilemap.move_circle(world.clearance, world.player.x / world.tile_size,
+                                      world.player.y / world.tile_size, PLAYER_RADIUS / world.tile_size,
+                                      distance * vx, distance * vy)
+        if (x * world.tile_size, y * world.tile_size) != (world.player.x, world.player.y):
+            world.player.x = x * world.tile_size
+            world.player.y = y * world.tile_size
             drawingarea.queue_draw()
-            client_protocol.send(type="position", x=world.player.x, y=world.player.y, rotation=world.player.rotation)
+            client_protocol.send_position()
 
     if "Up" in window_state.pressed_keys:
         world.player.health = min(1, world.player.health + time_elapsed * .2)
@@ -402,154 +181,415 @@ def handle_keys(time_elapsed):
 
 
 def animate(time_elapsed):
-    allocation = drawingarea.get_allocation()
-    tile_width = allocation.width / world.map_width
-    tile_height = allocation.height / world.map_height
-
-    for bullet in world.bullets[:]:
-        bullet.animate(time_elapsed)
-        hit_someone = False
-        for uuid, player in world.players.items():
-            if uuid == world.player_uuid:
-                continue
-            if (player.x - bullet.x)**2 + (player.y - bullet.y)**2 < 10**2:
-                # hit
-                client_protocol.send(type="hit", uuid=uuid, strength=.1)
-                hit_someone = True
-        if hit_someone:
-            world.bullets.remove(bullet)
-        else:
-            tile_x = int(bullet.x / tile_width)
-            tile_y = int(bullet.y / tile_height)
-            if 0 <= tile_x < world.map_width and 0 <= tile_y < world.map_height:
-                if world.map[tile_y][tile_x] == "#":
-                    world.bullets.remove(bullet)
+    if world.bullets:
+        world.bullets.animate(time_elapsed, world.players, world.map, world.tile_size)
         drawingarea.queue_draw()
 
 
-def tick():
-    current_time = time.perf_counter()
-    time_elapsed = current_time - window_state.tick_time
-    window_state.tick_time = current_time
+def simulation_idle() -> bool:
+    """
+    Test if a simulation step would change nothing, then the client waits for input or messages.
+    """
+    return not world.bullets and not window_state.pressed_keys & SIMULATED_KEYS \
+        and (world.player.previous_x, world.player.previous_y) == (world.player.x, world.player.y)
 
-    if not world.map:
-        return True
 
-    handle_keys(time_elapsed)
-    animate(time_elapsed)
+def render_time() -> float:
+    """
+    Return the server time the other players are shown at, a little behind the newest snapshot.
+    """
+    return loop.time() - world.clock_offset - INTERPOLATION_DELAY
 
-    return True
+
+def start_simulation() -> None:
+    if window_state.tick_callback is None:
+        window_state.tick_callback = drawingarea.add_tick_callback(frame)
+        window_state.frame_time = None
+
+
+def frame(widget: Gtk.Widget, frame_clock: Gdk.FrameClock) -> bool:
+    """
+    Run the simulation steps that are due at this frame with a fixed time step, the frame is drawn between the last
+    two of them. Other players are shown where they were a little earlier, between the snapshots around that time.
+    """
+    frame_time = frame_clock.get_frame_time() / 1e6
+    if window_state.frame_time is None:
+        window_state.frame_time = frame_time
+        window_state.accumulator = 0
+    window_state.accumulator = min(
+        window_state.accumulator + frame_time - window_state.frame_time, MAX_STEPS_PER_FRAME / SIMULATION_RATE)
+    window_state.frame_time = frame_time
+
+    if not world.map or not world.player:
+        window_state.tick_callback = None
+        return GLib.SOURCE_REMOVE
+
+    while window_state.accumulator >= 1 / SIMULATION_RATE:
+        window_state.accumulator -= 1 / SIMULATION_RATE
+        world.player.previous_x = world.player.x
+        world.player.previous_y = world.player.y
+        with frame_profiler.phase("keys"):
+            handle_keys(1 / SIMULATION_RATE)
+        with frame_profiler.phase("animate"):
+            animate(1 / SIMULATION_RATE)
+    window_state.interpolation = window_state.accumulator * SIMULATION_RATE
+
+    players_moving = False
+    if world.clock_offset is not None:
+        shown_time = render_time()
+        with frame_profiler.phase("interpolation"):
+            for uuid, player in world.players.items():
+                if uuid != world.player_uuid and player.interpolate_snapshots(shown_time):
+                    players_moving = True
+
+    if simulation_idle() and not players_moving:
+        window_state.tick_callback = None
+        window_state.interpolation = 1.
+        return GLib.SOURCE_REMOVE
+    widget.queue_draw()
+    return GLib.SOURCE_CONTINUE
+
+
+class ClientDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram channel to the server for positions, acks and snapshots, late datagrams are discarded.
+    """
+    def __init__(self, client_protocol: "ClientProtocol", token: str) -> None:
+        self.client_protocol = client_protocol
+        self.token = token
+        self.transport: asyncio.DatagramTransport = None
+        self.codec = protocol.DatagramCodec()
+        self.sent_sequence = 0
+        self.received_sequence = 0
+        self.registered = False
+
+    def send(self, **message) -> None:
+        self.sent_sequence += 1
+        self.transport.sendto(self.codec.encode(self.sent_sequence, message))
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.client_protocol.datagram_protocol = self
+        self.register()
+
+    def register(self) -> None:
+        if self.registered or self.transport.is_closing():
+            return
+        self.send(type="register", token=self.token)
+        loop.call_later(REGISTER_INTERVAL, self.register)
+
+    def datagram_received(self, data: bytes, address) -> None:
+        try:
+            with frame_profiler.phase("decode"):
+                sequence, message = self.codec.decode(data)
+        except ValueError:
+            print(f"received invalid datagram: {data!r}")
+            return
+        if sequence <= self.received_sequence:
+            return
+        self.received_sequence = sequence
+        if message.get("type") == "registered":
+            print("registered datagram channel")
+            self.registered = True
+        else:
+            with frame_profiler.phase("dispatch"):
+                self.client_protocol.dispatch_message(message)
 
 
 class ClientProtocol(asyncio.Protocol):
-    def __init__(self) -> None:
-        self.buffer = b""
+    def __init__(self, position_send_rate: Optional[float] = None) -> None:
+        """
+        position_send_rate is the number of positions sent per second at most, the tick rate of the server if it is
+        None, as the server only applies the last position it got before a tick.
+        """
+        self.buffer = protocol.FrameBuffer()
         self.transport: asyncio.WriteTransport = None
+        self.encoder = protocol.JsonCodec()
+        self.decoder = protocol.JsonCodec()
+        # snapshot states by tick, kept until the server uses a newer baseline
+        self.states: Dict[int, protocol.WorldState] = {0: {}}
+        # tick of the latest snapshot shown
+        self.tick = 0
+        self.datagram_protocol: ClientDatagramProtocol = None
+        # sequence number of the last position sent and the positions the server did not apply yet
+        self.input_sequence = 0
+        self.pending_inputs: Deque[Tuple[int, float, float]] = deque(maxlen=MAX_PENDING_INPUTS)
+        # changes of the own player are collected and sent by a timer
+        self.position_send_rate = position_send_rate
+        self.position_timer: asyncio.TimerHandle = None
+        self.sent_position: Optional[Tuple[float, float, float]] = None
+        self.position_sent_time = -math.inf
+        # frames written together at the end of the current iteration of the event loop
+        self.outbound: List[bytes] = []
 
     def send(self, **message) -> None:
-        self.transport.write(json.dumps(message).encode() + b"\n")
+        if not self.outbound:
+            loop.call_soon(self.flush)
+        self.outbound.append(self.encoder.encode(message))
+
+    def flush(self) -> None:
+        if self.outbound and not self.transport.is_closing():
+            self.transport.write(b"".join(self.outbound))
+        self.outbound.clear()
+
+    def send_unreliable(self, **message) -> None:
+        """
+        Send a message that is superseded by the next one of its type over the datagram channel if it is ready.
+        """
+        if self.datagram_protocol is not None and self.datagram_protocol.registered:
+            self.datagram_protocol.send(**message)
+        else:
+            self.send(**message)
+
+    def send_position(self) -> None:
+        """
+        Send the position of the own player soon, changes until then are sent together.
+        """
+        if self.position_timer is not None:
+            return
+        send_rate = self.position_send_rate or world.tick_rate
+        delay = self.position_sent_time + 1 / send_rate - loop.time()
+        if delay <= 0:
+            self.flush_position()
+        else:
+            self.position_timer = loop.call_later(delay, self.flush_position)
+
+    def flush_position(self) -> None:
+        """
+        Send the predicted position of the own player if it changed noticeably, numbered so the snapshot with the
+        server's position for it can correct the prediction.
+        """
+        self.position_timer = None
+        if self.sent_position is not None:
+            sent_x, sent_y, sent_rotation = self.sent_position
+            if abs(world.player.x - sent_x) < POSITION_THRESHOLD and abs(world.player.y - sent_y) < POSITION_THRESHOLD \
+                    and abs((world.player.rotation - sent_rotation + math.pi) % math.tau - math.pi) < ROTATION_THRESHOLD:
+                return
+        self.sent_position = (world.player.x, world.player.y, world.player.rotation)
+        self.position_sent_time = loop.time()
+        self.input_sequence += 1
+        self.pending_inputs.append((self.input_sequence, world.player.x, world.player.y))
+        self.send_unreliable(type="position", x=world.player.x, y=world.player.y, rotation=world.player.rotation,
+                             sequence=self.input_sequence)
+
+    def reconcile(self, input: int, x: float, y: float) -> None:
+        """
+        Compare the position the server applied for the input with the sent one and move the own player and the
+        positions sent after it by the difference.
+        """
+        while self.pending_inputs and self.pending_inputs[0][0] < input:
+            self.pending_inputs.popleft()
+        if not self.pending_inputs or self.pending_inputs[0][0] != input:
+            # already reconciled or sent so long ago that it was dropped
+            return
+        _, sent_x, sent_y = self.pending_inputs.popleft()
+        error_x = x - sent_x
+        error_y = y - sent_y
+        if abs(error_x) <= 1 / protocol.POSITION_SCALE and abs(error_y) <= 1 / protocol.POSITION_SCALE:
+            # only the quantization
+            return
+        world.player.x += error_x
+        world.player.y += error_y
+        world.player.previous_x += error_x
+        world.player.previous_y += error_y
+        self.pending_inputs = deque(
+            ((sequence, sent_x + error_x, sent_y + error_y) for sequence, sent_x, sent_y in self.pending_inputs),
+            maxlen=MAX_PENDING_INPUTS)
+
+    def send_view(self) -> None:
+        width, height = window_state.view_size
+        self.send(type="view", width=width, height=height)
 
     def connection_made(self, transport: asyncio.WriteTransport) -> None:
         self.transport = transport
+        self.send(type="hello", formats=[protocol.BinaryCodec.name, protocol.JsonCodec.name], udp=True)
+        if window_state.view_size is not None:
+            self.send_view()
 
     def connection_lost(self, exc) -> None:
+        if self.position_timer is not None:
+            self.position_timer.cancel()
+        if self.datagram_protocol is not None:
+            self.datagram_protocol.transport.close()
         print("server closed connection")
         print("stop the event loop")
         loop.stop()
 
     def data_received(self, data: bytes) -> None:
-        self.buffer += data
+        self.buffer.feed(data)
 
-        while b"\n" in self.buffer:
-            line, self.buffer = self.buffer.split(b"\n", 1)
+        while True:
+            # read one frame at a time, a handler may switch the decoder for the following frames
             try:
-                message = json.loads(line.decode())
-            except (UnicodeDecodeError, json.JSONDecodeError):
-                print(f"received invalid data: {line!r}")
+                frame = self.decoder.next_frame(self.buffer)
+            except protocol.FrameTooLarge as e:
+                print(f"closing connection: {e}")
+                self.transport.close()
                 return
-
-            message_type = message.pop("type", None)
-            if isinstance(message_type, str):
-                handler = getattr(self, f"handle_{message_type}", None)
-                if handler:
-                    try:
-                        handler(**message)
-                    except TypeError as e:
-                        print(f"invalid handler arguments: {e}")
-                else:
-                    print(f"invalid message type: {message_type!r}")
+            if frame is None:
+                break
+            try:
+                with frame_profiler.phase("decode"):
+                    message = self.decoder.decode(frame)
+            except ValueError:
+                print(f"received invalid data: {bytes(frame)!r}")
+                return
+            with frame_profiler.phase("dispatch"):
+                self.dispatch_message(message)
+
+    def dispatch_message(self, message: dict) -> None:
+        message_type = message.pop("type", None)
+        if isinstance(message_type, str):
+            handler = getattr(self, f"handle_{message_type}", None)
+            if handler:
+                try:
+                    handler(**message)
+                except TypeError as e:
+                    print(f"invalid handler arguments: {e}")
             else:
-                print("invalid message: type missing")
+                print(f"invalid message type: {message_type!r}")
+        else:
+            print("invalid message: type missing")
 
     def handle_error(self, error):
         print("got error from server:", error)
 
-    def handle_world(self, map):
-        world.map = map
-        world.map_height = len(world.map)
-        world.map_width = len(world.map[0])
+    def handle_format(self, format):
+        # the server sends this format from now on, answer in the old format and switch as well
+        self.decoder = protocol.CODECS[format]()
+        self.send(type="format", format=format)
+        self.encoder = protocol.CODECS[format]()
+
+    def handle_world(self, width, height, tile_size, chunk_size, tick_rate):
+        world.set_map(tilemap.TileMap(width, height), tile_size, chunk_size)
+        world.tick_rate = tick_rate
+
+    def handle_chunk(self, x, y, tiles):
+        world.set_chunk(x, y, base64.b64decode(tiles))
+        drawingarea.queue_draw()
 
     def handle_uuid(self, uuid):
         world.player_uuid = uuid
 
-    def handle_players(self, players):
-        for uuid, (x, y, rotation, health) in players.items():
-            if uuid not in world.players:
-                world.players[uuid] = Player(x, y, rotation, health)
+    def handle_udp(self, port, token):
+        host = self.transport.get_extra_info("peername")[0]
+        loop.create_task(loop.create_datagram_endpoint(
+            lambda: ClientDatagramProtocol(self, token), remote_addr=(host, port)))
+
+    def handle_snapshot(self, tick, baseline, input, joined, removed, players):
+        if tick <= self.tick:
+            # arrived after a newer snapshot over the datagram channel
+            return
+        if baseline not in self.states:
+            print(f"snapshot {tick} has unknown baseline {baseline}")
+            return
+        state = protocol.apply_delta(self.states[baseline], joined, removed, players)
+        self.states[tick] = state
+        self.tick = tick
+        for old_tick in [old_tick for old_tick in self.states if old_tick < baseline]:
+            del self.states[old_tick]
+        self.send_unreliable(type="ack", tick=tick)
+
+        server_time = tick / world.tick_rate
+        clock_offset = loop.time() - server_time
+        if world.clock_offset is None:
+            world.clock_offset = clock_offset
+        else:
+            world.clock_offset = min(clock_offset, world.clock_offset + CLOCK_RELAXATION)
+
+        uuids = set()
+        for player_state in state.values():
+            uuid = player_state[0]
+            uuids.add(uuid)
+            x, y, rotation, health = protocol.dequantize_player(player_state)
+            player = world.players.get(uuid)
+            if player is None:
+                player = world.players[uuid] = renderer.Player(x, y, rotation, health)
                 if uuid == world.player_uuid:
-                    world.player = world.players[uuid]
-            else:
-                world.players[uuid].x = x
-                world.players[uuid].y = y
-                world.players[uuid].rotation = rotation
-                world.players[uuid].health = health
+                    world.player = player
+            if uuid == world.player_uuid:
+                # the own player is predicted locally
+                self.reconcile(input, x, y)
+                continue
+            player.health = health
+            if player.snapshots and player.snapshots[-1][0] < server_time - 1.5 / world.tick_rate:
+                # unchanged states are not sent, so the player stood still until the tick before
+                player.snapshots.append((server_time - 1 / world.tick_rate, *player.snapshots[-1][1:]))
+            player.snapshots.append((server_time, x, y, rotation))
 
-        for disconnected_uuid in set(world.players) - set(players):
-            del world.players[disconnected_uuid]
+        for disconnected_uuid in set(world.players) - uuids:
+            world.remove_player(disconnected_uuid)
 
+        start_simulation()
         drawingarea.queue_draw()
 
-    def handle_position(self, uuid, x, y, rotation):
-        world.players[uuid].x = x
-        world.players[uuid].y = y
-        world.players[uuid].rotation = rotation
+    def handle_bullet(self, uuid, x, y, vx, vy):
+        world.bullets.add(x, y, vx, vy, uuid)
+        start_simulation()
         drawingarea.queue_draw()
 
     def handle_health(self, uuid, health):
+        if uuid not in world.players:
+            return
         world.players[uuid].health = health
         drawingarea.queue_draw()
 
 
-world = World()
+world = renderer.World()
 window_state = WindowState()
 control_settings = ControlSettings()
+frame_profiler = profiler.FrameProfiler()
+# created by main()
+drawingarea: Gtk.DrawingArea = None
+client_protocol: ClientProtocol = None
+
+
+def main() -> None:
+    global drawingarea, client_protocol
+
+    parser = argparse.ArgumentParser(description="shooter2d client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5661)
+    parser.add_argument("--profiler", action="store_true",
+                        help="show the frame timings from the start, F3 toggles them")
+    parser.add_argument("--profile-output", default="client.prof",
+                        help="file F4 captures a cProfile session to (default: %(default)s)")
+    args = parser.parse_args()
+    frame_profiler.capture_path = args.profile_output
+
+    win = Gtk.Window(title="Game")
+    # win.connect("destroy", Gtk.main_quit)
+    win.connect("destroy", lambda *args: loop.stop())
+
+    drawingarea = Gtk.DrawingArea()
+    win.add(drawingarea)
+    drawingarea.connect("draw", draw)
+    drawingarea.connect("size-allocate", resize)
+    drawingarea.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
+    drawingarea.connect("motion-notify-event", mouse_motion)
+    drawingarea.set_size_request(800, 800)
+
+    win.connect("button-press-event", press_button)
+    win.connect("key-press-event", press_key)
+    win.connect("key-release-event", release_key)
+
+    win.show_all()
+    if args.profiler:
+        toggle_profiler()
+
+    client_transport, client_protocol = loop.run_until_complete(
+        loop.create_connection(ClientProtocol, args.host, args.port))
 
-win = Gtk.Window(title="Game")
-# win.connect("destroy", Gtk.main_quit)
-win.connect("destroy", lambda *args: loop.stop())
-
-drawingarea = Gtk.DrawingArea()
-win.add(drawingarea)
-drawingarea.connect("draw", draw)
-drawingarea.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
-drawingarea.connect("motion-notify-event", mouse_motion)
-drawingarea.set_size_request(800, 800)
-
-win.connect("button-press-event", press_button)
-win.connect("key-press-event", press_key)
-win.connect("key-release-event", release_key)
-
-tick_timeout = GLib.timeout_add(1, tick)
-
-win.show_all()
+    try:
+        # Gtk.main()
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
 
-client_transport, client_protocol = loop.run_until_complete(loop.create_connection(ClientProtocol, "127.0.0.1", 5661))
+    frame_profiler.stop_capture()
+    client_transport.close()
+    loop.close()
 
-try:
-    # Gtk.main()
-    loop.run_forever()
-except KeyboardInterrupt:
-    pass
 
-client_transport.close()
-loop.close()
+if __name__ == "__main__":
+    main()
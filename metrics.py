@@ -0,0 +1,88 @@
+"""
+Counters, gauges and histograms for instrumenting the server
+"""
+import bisect
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Sequence
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> List[float]:
+    return [start * factor**i for i in range(count)]
+
+
+# upper bounds of the buckets for durations in seconds, from 1 µs to about 16 s
+DURATION_BUCKETS = exponential_buckets(1e-6, 2, 25)
+# upper bounds of the buckets for sizes in bytes, from 1 B to 16 MiB
+SIZE_BUCKETS = exponential_buckets(1, 2, 25)
+
+
+class Histogram:
+    """
+    Count of observed values per bucket, percentiles are estimated as the upper bound of their bucket.
+    """
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction: float) -> float:
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(.5),
+            "p90": self.percentile(.9),
+            "p99": self.percentile(.99),
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.start_time = time.time()
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+
+    def set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = DURATION_BUCKETS) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def summary(self) -> dict:
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.start_time,
+            "counters": dict(sorted(self.counters.items())),
+            "gauges": dict(sorted(self.gauges.items())),
+            "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary())
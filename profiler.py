@@ -0,0 +1,138 @@
+"""
+Frame profiler of the client
+
+Phases of the client (simulation steps, drawing passes and the handling of messages) are timed with ``with
+profiler.phase(name)`` while the profiler is enabled. Their time is summed up per drawn frame and kept for the last
+frames, so percentiles show which phase makes frames slow. A cProfile session of everything the client does can be
+captured to a file as well.
+"""
+import cProfile
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+# frames the percentiles are computed over
+WINDOW = 240
+# longer times between two frames are pauses of an idle client and not counted
+MAX_FRAME_INTERVAL = .25
+# seconds between updates of the summary, so it stays readable
+SUMMARY_INTERVAL = .5
+
+
+class Phase:
+    """
+    Adds the time spent in the with block to a phase of the current frame.
+    """
+    __slots__ = ("profiler", "name", "start_time")
+
+    def __init__(self, profiler: "FrameProfiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.start_time = 0.
+
+    def __enter__(self) -> None:
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.profiler.current[self.name] += time.perf_counter() - self.start_time
+
+
+class NoPhase:
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+NO_PHASE = NoPhase()
+
+
+def no_phase(name: str) -> NoPhase:
+    """
+    Stand-in for FrameProfiler.phase when there is no profiler.
+    """
+    return NO_PHASE
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Return the value below which the fraction of the sorted values is.
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.
+
+
+class FrameProfiler:
+    def __init__(self, capture_path: str = "client.prof", window: int = WINDOW) -> None:
+        # phases are only timed while enabled, otherwise they cost a method call
+        self.enabled = False
+        # seconds spent in each phase since the last frame
+        self.current: Dict[str, float] = defaultdict(float)
+        # seconds between the last frames and seconds of each phase in them
+        self.frame_intervals: Deque[float] = deque(maxlen=window)
+        self.phase_times: Dict[str, Deque[float]] = {}
+        self.window = window
+        self.last_frame_time: Optional[float] = None
+        self.summary: List[str] = []
+        self.summary_time = -SUMMARY_INTERVAL
+        self.capture_path = capture_path
+        self.capture: Optional[cProfile.Profile] = None
+
+    def phase(self, name: str):
+        return Phase(self, name) if self.enabled else NO_PHASE
+
+    def enable(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.current.clear()
+        self.last_frame_time = None
+
+    def end_frame(self) -> None:
+        """
+        Store the times of the phases since the last frame as the times of the frame that was just drawn.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.last_frame_time is not None and now - self.last_frame_time <= MAX_FRAME_INTERVAL:
+            self.frame_intervals.append(now - self.last_frame_time)
+        self.last_frame_time = now
+        for name in self.current.keys() - self.phase_times.keys():
+            self.phase_times[name] = deque(maxlen=self.window)
+        for name, times in self.phase_times.items():
+            times.append(self.current.get(name, 0.))
+        self.current.clear()
+
+    def summary_lines(self) -> List[str]:
+        """
+        Return lines with the percentiles of the frame interval and the phases in milliseconds.
+        """
+        now = time.perf_counter()
+        if now - self.summary_time < SUMMARY_INTERVAL:
+            return self.summary
+        self.summary_time = now
+        rows = [("frame", self.frame_intervals)] + sorted(self.phase_times.items())
+        self.summary = [f"{'ms':14} {'p50':>6} {'p95':>6} {'p99':>6} {'max':>6}"]
+        for name, times in rows:
+            values = sorted(times)
+            self.summary.append(f"{name:14} {percentile(values, .5) * 1000:6.2f} {percentile(values, .95) * 1000:6.2f} "
+                                f"{percentile(values, .99) * 1000:6.2f} {(values[-1] if values else 0) * 1000:6.2f}")
+        if self.capture is not None:
+            self.summary.append(f"capturing profile to {self.capture_path}")
+        return self.summary
+
+    def start_capture(self) -> None:
+        if self.capture is None:
+            self.capture = cProfile.Profile()
+            self.capture.enable()
+            self.summary_time = -SUMMARY_INTERVAL
+
+    def stop_capture(self) -> None:
+        """
+        Write the captured profile to the capture path, to be read with pstats.
+        """
+        if self.capture is not None:
+            self.capture.disable()
+            self.capture.dump_stats(self.capture_path)
+            print(f"wrote profile to {self.capture_path}")
+            self.capture = None
+            self.summary_time = -SUMMARY_INTERVAL
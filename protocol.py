@@ -0,0 +1,337 @@
+"""
+Wire formats shared by server and client
+
+Every connection starts with newline-delimited JSON. The client offers the formats it supports with a ``hello``
+message, the server answers with a ``format`` message and both sides switch their outgoing frames to that format
+right after announcing it, so the last frame in the old format is always the ``format`` message itself.
+
+Player state is sent as delta snapshots: the server remembers the last snapshot the client acknowledged (the
+baseline) and only sends the players and fields that differ from it. All fields are quantized to integers, so
+changes below the quantization step are not sent at all.
+
+Clients number the positions they send. Every snapshot contains the number of the last position of the receiving
+client the server applied, so the client can correct its prediction of its own player.
+
+Positions, acks and snapshots can optionally be sent over UDP. The client asks for it in its ``hello`` message, the
+server answers with a ``udp`` message containing the port and a token, and the client sends the token in
+``register`` datagrams until the server answers with a ``registered`` datagram. Everything else stays on the stream.
+"""
+import json
+import math
+import struct
+import uuid as uuid_module
+from typing import Dict, List, Optional, Tuple
+
+# quantization steps of the snapshot fields
+POSITION_SCALE = 16
+ROTATION_SCALE = 0x10000 / math.tau
+HEALTH_SCALE = 1000
+
+# fields of a player in a snapshot, the bit i of a delta mask is set if FIELDS[i] changed
+FIELDS = ("x", "y", "rotation", "health")
+
+# quantized player states by player id
+PlayerState = Tuple[str, int, int, int, int]
+WorldState = Dict[int, PlayerState]
+
+# position sequence numbers are sent as unsigned 32 bit integers
+MAX_SEQUENCE = 0xffffffff
+
+# largest frame accepted from the other side, the connection is closed if it sends a larger one
+MAX_FRAME_SIZE = 0x10000
+# larger messages are sent over the stream instead, so datagrams are not fragmented on the way
+MAX_DATAGRAM_SIZE = 1200
+
+
+class InvalidMessage(ValueError):
+    pass
+
+
+class FrameTooLarge(InvalidMessage):
+    pass
+
+
+def quantize_player(uuid: str, x: float, y: float, rotation: float, health: float) -> PlayerState:
+    return (
+        uuid,
+        round(x * POSITION_SCALE),
+        round(y * POSITION_SCALE),
+        round(rotation % math.tau * ROTATION_SCALE) & 0xffff,
+        round(health * HEALTH_SCALE),
+    )
+
+
+def dequantize_player(state: PlayerState) -> Tuple[float, float, float, float]:
+    uuid, x, y, rotation, health = state
+    return x / POSITION_SCALE, y / POSITION_SCALE, rotation / ROTATION_SCALE, health / HEALTH_SCALE
+
+
+def diff_states(baseline: WorldState, state: WorldState) -> dict:
+    """
+    Return the fields of a snapshot message that turn baseline into state.
+
+    A player whose id got reused by another uuid is sent as joined again with all fields.
+    """
+    joined = []
+    removed = [player_id for player_id in baseline if player_id not in state]
+    players = []
+    for player_id, player in state.items():
+        base = baseline.get(player_id)
+        if base is None or base[0] != player[0]:
+            joined.append([player_id, player[0]])
+            base = None
+        mask = 0
+        values = []
+        for i, value in enumerate(player[1:]):
+            if base is None or base[i + 1] != value:
+                mask |= 1 << i
+                values.append(value)
+        if mask:
+            players.append([player_id, mask, *values])
+    return {"joined": joined, "removed": removed, "players": players}
+
+
+def apply_delta(baseline: WorldState, joined: list, removed: list, players: list) -> WorldState:
+    """
+    Apply the fields of a snapshot message to baseline and return the new state.
+    """
+    state = dict(baseline)
+    for player_id in removed:
+        state.pop(player_id, None)
+    for player_id, uuid in joined:
+        state[player_id] = (uuid, 0, 0, 0, 0)
+    for player_id, mask, *values in players:
+        player = list(state[player_id])
+        values = iter(values)
+        for i in range(len(FIELDS)):
+            if mask & 1 << i:
+                player[i + 1] = next(values)
+        state[player_id] = tuple(player)
+    return state
+
+
+class FrameBuffer:
+    """
+    Receive buffer that frames are read from without copying the rest of the buffer.
+
+    Frames are memoryviews into the buffer, they are only valid until the next call of feed(). Consumed bytes are
+    dropped once they make up half of the buffer, so a burst of frames costs linear time in its size.
+    """
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE) -> None:
+        self.data = bytearray()
+        self.offset = 0
+        # position up to which the unread data is known not to contain a newline
+        self.scanned = 0
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data: bytes) -> None:
+        if self.offset and self.offset * 2 >= len(self.data):
+            try:
+                del self.data[:self.offset]
+            except BufferError:
+                # a frame of the last call is still referenced, keep it intact and continue in a new buffer
+                self.data = self.data[self.offset:]
+            self.scanned -= self.offset
+            self.offset = 0
+        try:
+            self.data += data
+        except BufferError:
+            self.data = self.data + data
+
+    def read_line(self) -> Optional[memoryview]:
+        """
+        Return the next newline-terminated frame without the newline, None if it is not complete yet.
+        """
+        end = self.data.find(b"\n", max(self.offset, self.scanned))
+        if end < 0:
+            self.scanned = len(self.data)
+            if self.scanned - self.offset > self.max_frame_size:
+                raise FrameTooLarge(f"no newline within {self.max_frame_size} bytes")
+            return None
+        if end - self.offset > self.max_frame_size:
+            raise FrameTooLarge(f"frame too large: {end - self.offset} bytes")
+        frame = memoryview(self.data)[self.offset:end]
+        self.offset = end + 1
+        return frame
+
+    def read_prefixed(self, length: struct.Struct) -> Optional[memoryview]:
+        """
+        Return the next frame prefixed with its length, None if it is not complete yet.
+        """
+        if len(self.data) - self.offset < length.size:
+            return None
+        frame_length, = length.unpack_from(self.data, self.offset)
+        if frame_length > self.max_frame_size:
+            raise FrameTooLarge(f"frame too large: {frame_length} bytes")
+        start = self.offset + length.size
+        end = start + frame_length
+        if len(self.data) < end:
+            return None
+        frame = memoryview(self.data)[start:end]
+        self.offset = end
+        return frame
+
+
+class JsonCodec:
+    """
+    Newline-delimited JSON objects.
+    """
+    name = "json"
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message).encode() + b"\n"
+
+    def next_frame(self, buffer: FrameBuffer) -> Optional[memoryview]:
+        return buffer.read_line()
+
+    def decode(self, frame: memoryview) -> dict:
+        message = json.loads(str(frame, "utf-8"))
+        if not isinstance(message, dict):
+            raise InvalidMessage("message is not an object")
+        return message
+
+
+class BinaryCodec:
+    """
+    Length-prefixed frames with struct-packed bodies for the high frequency messages.
+
+    A frame is a little-endian uint16 body length followed by the body. The first byte of the body is the message
+    code, position, snapshot and ack messages are packed, every other message is sent as JSON inside the frame.
+    """
+    name = "binary"
+
+    length = struct.Struct("<H")
+    code = struct.Struct("<B")
+    position = struct.Struct("<fffI")
+    ack = struct.Struct("<I")
+    snapshot_header = struct.Struct("<IIIHHH")
+    snapshot_joined = struct.Struct("<H16s")
+    snapshot_removed = struct.Struct("<H")
+    snapshot_player = struct.Struct("<HB")
+    # one struct per entry of FIELDS
+    snapshot_fields = (struct.Struct("<i"), struct.Struct("<i"), struct.Struct("<H"), struct.Struct("<H"))
+
+    CODE_JSON = 0
+    CODE_POSITION = 1
+    CODE_SNAPSHOT = 2
+    CODE_ACK = 3
+
+    def encode(self, message: dict) -> bytes:
+        body = self.encode_body(message)
+        if len(body) > 0xffff:
+            raise ValueError(f"frame too large: {len(body)} bytes")
+        return self.length.pack(len(body)) + body
+
+    def encode_body(self, message: dict) -> bytes:
+        message_type = message.get("type")
+        if message_type == "position" and message.keys() == {"type", "x", "y", "rotation", "sequence"}:
+            body = self.code.pack(self.CODE_POSITION) \
+                + self.position.pack(message["x"], message["y"], message["rotation"], message["sequence"])
+        elif message_type == "ack" and message.keys() == {"type", "tick"}:
+            body = self.code.pack(self.CODE_ACK) + self.ack.pack(message["tick"])
+        elif message_type == "snapshot":
+            body = self.code.pack(self.CODE_SNAPSHOT) + self.encode_snapshot(message)
+        else:
+            body = self.code.pack(self.CODE_JSON) + json.dumps(message).encode()
+        return body
+
+    def encode_snapshot(self, message: dict) -> bytes:
+        parts = [self.snapshot_header.pack(
+            message["tick"], message["baseline"], message["input"],
+            len(message["joined"]), len(message["removed"]), len(message["players"]),
+        )]
+        for player_id, uuid in message["joined"]:
+            parts.append(self.snapshot_joined.pack(player_id, uuid_module.UUID(uuid).bytes))
+        for player_id in message["removed"]:
+            parts.append(self.snapshot_removed.pack(player_id))
+        for player_id, mask, *values in message["players"]:
+            parts.append(self.snapshot_player.pack(player_id, mask))
+            values = iter(values)
+            for i, field in enumerate(self.snapshot_fields):
+                if mask & 1 << i:
+                    parts.append(field.pack(next(values)))
+        return b"".join(parts)
+
+    def next_frame(self, buffer: FrameBuffer) -> Optional[memoryview]:
+        return buffer.read_prefixed(self.length)
+
+    def decode(self, frame: memoryview) -> dict:
+        if not frame:
+            raise InvalidMessage("empty frame")
+        code = frame[0]
+        try:
+            if code == self.CODE_JSON:
+                message = json.loads(str(frame[1:], "utf-8"))
+                if not isinstance(message, dict):
+                    raise InvalidMessage("message is not an object")
+                return message
+            elif code == self.CODE_POSITION:
+                x, y, rotation, sequence = self.position.unpack_from(frame, 1)
+                return {"type": "position", "x": x, "y": y, "rotation": rotation, "sequence": sequence}
+            elif code == self.CODE_ACK:
+                tick, = self.ack.unpack_from(frame, 1)
+                return {"type": "ack", "tick": tick}
+            elif code == self.CODE_SNAPSHOT:
+                return self.decode_snapshot(frame)
+        except struct.error as e:
+            raise InvalidMessage(str(e)) from e
+        raise InvalidMessage(f"unknown message code: {code}")
+
+    def decode_snapshot(self, frame: memoryview) -> dict:
+        tick, baseline, input, joined_count, removed_count, players_count = \
+            self.snapshot_header.unpack_from(frame, 1)
+        offset = 1 + self.snapshot_header.size
+        joined = []
+        for _ in range(joined_count):
+            player_id, uuid_bytes = self.snapshot_joined.unpack_from(frame, offset)
+            offset += self.snapshot_joined.size
+            joined.append([player_id, str(uuid_module.UUID(bytes=uuid_bytes))])
+        removed = []
+        for _ in range(removed_count):
+            player_id, = self.snapshot_removed.unpack_from(frame, offset)
+            offset += self.snapshot_removed.size
+            removed.append(player_id)
+        players: List[list] = []
+        for _ in range(players_count):
+            player_id, mask = self.snapshot_player.unpack_from(frame, offset)
+            offset += self.snapshot_player.size
+            player = [player_id, mask]
+            for i, field in enumerate(self.snapshot_fields):
+                if mask & 1 << i:
+                    player.extend(field.unpack_from(frame, offset))
+                    offset += field.size
+            players.append(player)
+        if offset != len(frame):
+            raise InvalidMessage("invalid snapshot length")
+        return {
+            "type": "snapshot", "tick": tick, "baseline": baseline, "input": input,
+            "joined": joined, "removed": removed, "players": players,
+        }
+
+
+class DatagramCodec:
+    """
+    One message per datagram: a little-endian uint32 sequence number followed by a body in the binary format.
+
+    Every sender numbers its datagrams, receivers discard datagrams that are not newer than the last one they got,
+    so a late datagram never overwrites a newer state.
+    """
+    sequence = struct.Struct("<I")
+
+    def __init__(self) -> None:
+        self.body = BinaryCodec()
+
+    def encode(self, sequence: int, message: dict) -> bytes:
+        return self.sequence.pack(sequence) + self.body.encode_body(message)
+
+    def decode(self, datagram: bytes) -> Tuple[int, dict]:
+        if len(datagram) < self.sequence.size:
+            raise InvalidMessage("datagram too short")
+        sequence, = self.sequence.unpack_from(datagram)
+        return sequence, self.body.decode(memoryview(datagram)[self.sequence.size:])
+
+
+CODECS: Dict[str, type] = {
+    JsonCodec.name: JsonCodec,
+    BinaryCodec.name: BinaryCodec,
+}
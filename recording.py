@@ -0,0 +1,238 @@
+"""
+Append-only log of everything a server receives and sends
+
+A recording starts with a header (magic bytes and a JSON object with the settings of the server) followed by
+records. Every record has a small fixed size header with its kind, the codec of the payload, the time since the
+start of the recording, the player id of the connection and the payload length. Messages are stored as the frames
+that went over the wire, without their framing, so recording costs no extra encoding.
+
+Keyframes store the players of the world and the snapshot states of every connection, so a replay can start at any
+keyframe without reading what came before. Their offsets are appended to an index file next to the recording.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+import uuid as uuid_module
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import protocol
+
+MAGIC = b"S2DR"
+HEADER_LENGTH = struct.Struct("<I")
+# kind, codec, seconds since the start, player id of the connection, payload length
+RECORD = struct.Struct("<BBdHI")
+# seconds since the start, offset of the keyframe in the recording
+INDEX_ENTRY = struct.Struct("<dQ")
+
+KIND_IN = 0
+KIND_OUT = 1
+KIND_CONNECT = 2
+KIND_DISCONNECT = 3
+KIND_KEYFRAME = 4
+
+# codecs of the payloads of messages, indexes of this tuple are stored in the records
+CODEC_NAMES = (protocol.JsonCodec.name, protocol.BinaryCodec.name, "datagram")
+CODEC_JSON, CODEC_BINARY, CODEC_DATAGRAM = range(len(CODEC_NAMES))
+CODEC_IDS = {name: codec_id for codec_id, name in enumerate(CODEC_NAMES)}
+
+KEYFRAME_HEADER = struct.Struct("<IHH")
+KEYFRAME_PLAYER = struct.Struct("<16sffff")
+KEYFRAME_CONNECTION = struct.Struct("<H16sIH")
+KEYFRAME_STATE = struct.Struct("<IH")
+
+
+class Record(NamedTuple):
+    kind: int
+    codec: int
+    time: float
+    connection: int
+    payload: memoryview
+    offset: int
+
+
+class ConnectionState(NamedTuple):
+    """
+    Snapshot states of a connection: the acknowledged baseline and the states sent but not acknowledged yet.
+    """
+    id: int
+    uuid: str
+    baseline_tick: int
+    states: Dict[int, protocol.WorldState]
+
+
+class Keyframe(NamedTuple):
+    tick: int
+    # x, y, rotation and health by uuid
+    players: Dict[str, Tuple[float, float, float, float]]
+    connections: List[ConnectionState]
+
+
+def encode_state(state: protocol.WorldState) -> bytes:
+    message = dict(type="snapshot", tick=0, baseline=0, input=0, **protocol.diff_states({}, state))
+    return protocol.BinaryCodec().encode_snapshot(message)
+
+
+def decode_state(data: memoryview) -> protocol.WorldState:
+    # decode_snapshot expects the message code in front of the snapshot
+    message = protocol.BinaryCodec().decode_snapshot(memoryview(b"\0" + bytes(data)))
+    return protocol.apply_delta({}, message["joined"], message["removed"], message["players"])
+
+
+def encode_keyframe(keyframe: Keyframe) -> bytes:
+    parts = [KEYFRAME_HEADER.pack(keyframe.tick, len(keyframe.players), len(keyframe.connections))]
+    for uuid, (x, y, rotation, health) in keyframe.players.items():
+        parts.append(KEYFRAME_PLAYER.pack(uuid_module.UUID(uuid).bytes, x, y, rotation, health))
+    for connection in keyframe.connections:
+        parts.append(KEYFRAME_CONNECTION.pack(
+            connection.id, uuid_module.UUID(connection.uuid).bytes, connection.baseline_tick,
+            len(connection.states)))
+        for tick, state in connection.states.items():
+            data = encode_state(state)
+            parts.append(KEYFRAME_STATE.pack(tick, len(data)))
+            parts.append(data)
+    return b"".join(parts)
+
+
+def decode_keyframe(data: memoryview) -> Keyframe:
+    tick, player_count, connection_count = KEYFRAME_HEADER.unpack_from(data)
+    offset = KEYFRAME_HEADER.size
+    players = {}
+    for _ in range(player_count):
+        uuid_bytes, *player = KEYFRAME_PLAYER.unpack_from(data, offset)
+        offset += KEYFRAME_PLAYER.size
+        players[str(uuid_module.UUID(bytes=uuid_bytes))] = tuple(player)
+    connections = []
+    for _ in range(connection_count):
+        player_id, uuid_bytes, baseline_tick, state_count = KEYFRAME_CONNECTION.unpack_from(data, offset)
+        offset += KEYFRAME_CONNECTION.size
+        states = {}
+        for _ in range(state_count):
+            state_tick, length = KEYFRAME_STATE.unpack_from(data, offset)
+            offset += KEYFRAME_STATE.size
+            states[state_tick] = decode_state(data[offset:offset + length])
+            offset += length
+        connections.append(ConnectionState(player_id, str(uuid_module.UUID(bytes=uuid_bytes)), baseline_tick, states))
+    return Keyframe(tick, players, connections)
+
+
+class Recorder:
+    """
+    Writer of a recording, records are buffered and flushed with every keyframe.
+    """
+    def __init__(self, path: str, settings: dict) -> None:
+        self.path = path
+        self.start_time = time.monotonic()
+        self.file: BinaryIO = open(path, "wb", buffering=0x10000)
+        self.index_file: BinaryIO = open(index_path(path), "wb")
+        header = json.dumps({"start_time": time.time(), **settings}).encode()
+        self.file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self.offset = len(MAGIC) + HEADER_LENGTH.size + len(header)
+        self.records = 0
+
+    def record(self, kind: int, codec: int, connection: int, payload: bytes) -> None:
+        self.file.write(RECORD.pack(kind, codec, time.monotonic() - self.start_time, connection, len(payload)))
+        self.file.write(payload)
+        self.offset += RECORD.size + len(payload)
+        self.records += 1
+
+    def record_frame(self, kind: int, codec_name: str, connection: int, frame: bytes) -> None:
+        """
+        Record a frame encoded by the codec with the given name, with or without its framing.
+        """
+        codec = CODEC_IDS[codec_name]
+        if kind == KIND_OUT:
+            # strip the framing added by encode(), next_frame() already stripped it from received frames
+            frame = memoryview(frame)
+            if codec == CODEC_JSON:
+                frame = frame[:-1]
+            elif codec == CODEC_BINARY:
+                frame = frame[protocol.BinaryCodec.length.size:]
+        self.record(kind, codec, connection, frame)
+
+    def keyframe(self, keyframe: Keyframe) -> None:
+        offset = self.offset
+        self.record(KIND_KEYFRAME, 0, 0, encode_keyframe(keyframe))
+        self.file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(time.monotonic() - self.start_time, offset))
+        self.index_file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+        self.index_file.close()
+
+
+def index_path(path: str) -> str:
+    return path + ".index"
+
+
+class Recording:
+    """
+    Reader of a recording, the file is memory-mapped so only the parts that are read are loaded.
+    """
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a recording")
+        header_length, = HEADER_LENGTH.unpack_from(self.data, len(MAGIC))
+        start = len(MAGIC) + HEADER_LENGTH.size
+        self.settings: dict = json.loads(self.data[start:start + header_length])
+        self.start_offset = start + header_length
+        self.index = self.read_index(path)
+        self.index_times = [keyframe_time for keyframe_time, _ in self.index]
+
+    def read_index(self, path: str) -> List[Tuple[float, int]]:
+        if not os.path.exists(index_path(path)):
+            # rebuild it, only the record headers are read
+            return [(record.time, record.offset) for record in self.records() if record.kind == KIND_KEYFRAME]
+        with open(index_path(path), "rb") as f:
+            data = f.read()
+        # the last entry may be incomplete if the server was killed while writing it
+        return [entry for entry in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size])
+                if entry[1] < len(self.data)]
+
+    def records(self, offset: Optional[int] = None) -> Iterator[Record]:
+        offset = self.start_offset if offset is None else offset
+        view = memoryview(self.data)
+        while offset + RECORD.size <= len(self.data):
+            kind, codec, record_time, connection, length = RECORD.unpack_from(self.data, offset)
+            start = offset + RECORD.size
+            if start + length > len(self.data):
+                # cut off while the server was writing it
+                return
+            yield Record(kind, codec, record_time, connection, view[start:start + length], offset)
+            offset = start + length
+
+    def seek(self, seconds: float) -> int:
+        """
+        Return the offset of the last keyframe at or before the given time, the start if there is none.
+        """
+        i = bisect.bisect_right(self.index_times, seconds)
+        return self.index[i - 1][1] if i else self.start_offset
+
+    def close(self) -> None:
+        try:
+            self.data.close()
+        except BufferError:
+            # records are still referenced, the mapping is closed once they are garbage collected
+            pass
+
+
+_DECODERS = {
+    CODEC_JSON: protocol.JsonCodec(),
+    CODEC_BINARY: protocol.BinaryCodec(),
+}
+_DATAGRAM_DECODER = protocol.DatagramCodec()
+
+
+def decode_message(record: Record) -> dict:
+    """
+    Decode the message of an in or out record, raise InvalidMessage if the payload is not a valid message.
+    """
+    if record.codec == CODEC_DATAGRAM:
+        _, message = _DATAGRAM_DECODER.decode(record.payload)
+        return message
+    return _DECODERS[record.codec].decode(record.payload)
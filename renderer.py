@@ -0,0 +1,489 @@
+"""
+The world as the client knows it and its drawing with cairo
+
+Nothing here depends on Gtk or a connection to the server, so the world can also be drawn onto an image surface,
+e.g. by the benchmarks. Wall geometry, the visibility polygon, the shadow and the walls are cached on the world and
+only computed again when the map, the position of the player or the size of the view changed.
+"""
+import contextlib
+import math
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import cairo
+import numpy
+
+import profiler
+import tilemap
+import visibility
+
+# pixels around the view that are drawn into the wall layer, it is drawn again when the camera moved further
+WALL_LAYER_MARGIN = 256
+# shooters remembered before those without bullets are forgotten, it grows with the shooters that have bullets
+MIN_SHOOTER_LIMIT = 64
+
+
+@contextlib.contextmanager
+def save_context(cr: cairo.Context) -> cairo.Context:
+    cr.save()
+    yield
+    cr.restore()
+
+
+class Rectangle:
+    def __init__(self, left: float, right: float, top: float, bottom: float) -> None:
+        self.left = left
+        self.right = right
+        self.top = top
+        self.bottom = bottom
+        self.width = right - left
+        self.height = bottom - top
+        self.x = left + self.width / 2
+        self.y = top + self.height / 2
+
+
+class Player:
+    def __init__(self, x: float, y: float, rotation: float, health: float) -> None:
+        self.x = x
+        self.y = y
+        self.rotation = rotation
+        self.health = health
+        # position before the last simulation step, only kept for the own player
+        self.previous_x = x
+        self.previous_y = y
+        # server time, x, y and rotation of the snapshots of other players that are not shown yet, and the last one
+        # that was
+        self.snapshots: Deque[Tuple[float, float, float, float]] = deque()
+
+    def interpolate_snapshots(self, render_time: float) -> bool:
+        """
+        Move the player to where it was at the render time between the snapshots around it, return whether it still
+        moves towards a newer snapshot.
+        """
+        while len(self.snapshots) > 1 and self.snapshots[1][0] <= render_time:
+            self.snapshots.popleft()
+        time0, x0, y0, rotation0 = self.snapshots[0]
+        if len(self.snapshots) == 1 or render_time <= time0:
+            self.x, self.y, self.rotation = x0, y0, rotation0
+            return len(self.snapshots) > 1
+        time1, x1, y1, rotation1 = self.snapshots[1]
+        fraction = (render_time - time0) / (time1 - time0)
+        self.x = x0 + fraction * (x1 - x0)
+        self.y = y0 + fraction * (y1 - y0)
+        # turn the shorter way
+        self.rotation = rotation0 + fraction * ((rotation1 - rotation0 + math.pi) % math.tau - math.pi)
+        return True
+
+    def interpolate(self, fraction: float) -> Tuple[float, float]:
+        return (self.previous_x + fraction * (self.x - self.previous_x),
+                self.previous_y + fraction * (self.y - self.previous_y))
+
+
+class Bullets:
+    """
+    Bullets are only shown by the client, the server simulates them and decides about hits.
+
+    They are stored as arrays of positions, velocities and shooters, so all of them are moved and tested at once.
+    """
+    def __init__(self, capacity: int = 64) -> None:
+        self.count = 0
+        self.positions = numpy.empty((capacity, 2))
+        # positions before the last simulation step
+        self.previous_positions = numpy.empty((capacity, 2))
+        self.velocities = numpy.empty((capacity, 2))
+        # index of the uuid of the shooter in shooter_uuids
+        self.shooters = numpy.empty(capacity, dtype=numpy.int32)
+        self.shooter_uuids: Dict[str, int] = {}
+        self.shooter_limit = MIN_SHOOTER_LIMIT
+
+    def __len__(self) -> int:
+        return self.count
+
+    def shooter_index(self, uuid: str) -> int:
+        return self.shooter_uuids.setdefault(uuid, len(self.shooter_uuids))
+
+    def add(self, x: float, y: float, vx: float, vy: float, shooter_uuid: str) -> None:
+        if self.count == len(self.positions):
+            capacity = 2 * len(self.positions)
+            self.positions = numpy.resize(self.positions, (capacity, 2))
+            self.previous_positions = numpy.resize(self.previous_positions, (capacity, 2))
+            self.velocities = numpy.resize(self.velocities, (capacity, 2))
+            self.shooters = numpy.resize(self.shooters, capacity)
+        self.positions[self.count] = x, y
+        self.previous_positions[self.count] = x, y
+        self.velocities[self.count] = vx, vy
+        self.shooters[self.count] = self.shooter_index(shooter_uuid)
+        self.count += 1
+
+    def interpolate(self, fraction: float) -> numpy.ndarray:
+        previous_positions = self.previous_positions[:self.count]
+        return previous_positions + fraction * (self.positions[:self.count] - previous_positions)
+
+    def animate(self, time_elapsed: float, players: Dict[str, Player], map: tilemap.TileMap, tile_size: int) -> None:
+        """
+        Move the bullets and remove those that hit a player other than their shooter, a wall or left the map.
+        """
+        positions = self.positions[:self.count]
+        self.previous_positions[:self.count] = positions
+        positions += time_elapsed * self.velocities[:self.count]
+
+        alive = numpy.ones(self.count, dtype=bool)
+        if players:
+            # hit, the server sends the new health
+            player_positions = numpy.array([(player.x, player.y) for player in players.values()])
+            # players that have no bullets get an index no bullet has
+            player_shooters = numpy.array([self.shooter_uuids.get(uuid, -1) for uuid in players])
+            distances = ((positions[:, numpy.newaxis] - player_positions)**2).sum(axis=2)
+            hits = (distances < 10**2) & (self.shooters[:self.count, numpy.newaxis] != player_shooters)
+            alive &= ~hits.any(axis=1)
+
+        tiles = numpy.floor(positions / tile_size).astype(numpy.intp)
+        alive &= (tiles >= 0).all(axis=1) & (tiles[:, 0] < map.width) & (tiles[:, 1] < map.height)
+        map_tiles = numpy.frombuffer(map.tiles, dtype=numpy.uint8).reshape(map.height, map.width)
+        alive[alive] = map_tiles[tiles[alive, 1], tiles[alive, 0]] != tilemap.WALL
+
+        # move the remaining bullets to the front
+        remaining = numpy.flatnonzero(alive)
+        self.count = len(remaining)
+        self.positions[:self.count] = positions[remaining]
+        self.previous_positions[:self.count] = self.previous_positions[remaining]
+        self.velocities[:self.count] = self.velocities[remaining]
+        self.shooters[:self.count] = self.shooters[remaining]
+        if len(self.shooter_uuids) > self.shooter_limit:
+            self.forget_shooters()
+            self.shooter_limit = max(MIN_SHOOTER_LIMIT, 2 * len(self.shooter_uuids))
+
+    def forget_shooters(self) -> None:
+        """
+        Forget the shooters without bullets and number the remaining ones from 0 again.
+        """
+        indices = numpy.unique(self.shooters[:self.count])
+        # shooters are numbered in the order they were added
+        uuids = list(self.shooter_uuids)
+        self.shooter_uuids = {uuids[index]: new_index for new_index, index in enumerate(indices)}
+        self.shooters[:self.count] = numpy.searchsorted(indices, self.shooters[:self.count])
+
+
+class WallGeometry:
+    """
+    Walls of a chunk of the map in pixels: merged rectangles and the borders between walls and free tiles.
+    """
+    def __init__(self, world: "World", chunk_x: int, chunk_y: int) -> None:
+        left = chunk_x * world.chunk_size
+        top = chunk_y * world.chunk_size
+        right = min(left + world.chunk_size, world.map.width)
+        bottom = min(top + world.chunk_size, world.map.height)
+        size = world.tile_size
+        self.rectangles = [
+            Rectangle(x * size, (x + width) * size, y * size, (y + height) * size)
+            for x, y, width, height in tilemap.wall_rectangles(world.map, left, top, right, bottom)
+        ]
+        self.edges = [
+            (x1 * size, y1 * size, x2 * size, y2 * size)
+            for x1, y1, x2, y2 in tilemap.wall_edges(world.map, left, top, right, bottom)
+        ]
+
+
+class World:
+    def __init__(self) -> None:
+        # the map arrives in chunks, tiles of chunks that were not received yet are free
+        self.map: tilemap.TileMap = None
+        # distance of the tiles to the walls for moving the own player, blocks of it are forgotten when chunks arrive
+        self.clearance: tilemap.ClearanceField = None
+        self.tile_size: int = None
+        self.chunk_size: int = None
+        self.tick_rate: float = None
+        # smallest difference between the local time a snapshot arrived at and its server time seen recently
+        self.clock_offset: float = None
+        # wall geometry by chunk, built when a chunk is drawn the first time after it or a neighbour changed
+        self.geometry: Dict[Tuple[int, int], WallGeometry] = {}
+        # visibility polygon of the player and the position and view size it was computed for
+        self.visibility_key: Tuple[float, float, float, float] = None
+        self.visibility_polygon: List[Tuple[float, float]] = []
+        # shadow of the view, drawn again only when the visibility polygon changed
+        self.shadow_surface: cairo.ImageSurface = None
+        self.shadow_polygon: List[Tuple[float, float]] = None
+        # walls drawn once for the view and its margin, the area is None when they have to be drawn again
+        self.wall_layer: cairo.Surface = None
+        self.wall_layer_size: Tuple[int, int] = None
+        self.wall_layer_area: Rectangle = None
+        # whether other players are in the line of sight by uuid, with the positions the test was done for
+        self.line_of_sight: Dict[str, Tuple[Tuple[float, float, float, float], bool]] = {}
+        self.player_uuid: str = None
+        self.player: Player = None
+        self.max_speed = 70
+        self.bullets = Bullets()
+        self.players: Dict[str, Player] = {}
+
+    def set_map(self, map: tilemap.TileMap, tile_size: int, chunk_size: int) -> None:
+        self.map = map
+        self.clearance = tilemap.ClearanceField(map)
+        self.tile_size = tile_size
+        self.chunk_size = chunk_size
+        self.geometry = {}
+        self.visibility_key = None
+        self.wall_layer_area = None
+        self.line_of_sight = {}
+
+    def set_chunk(self, x: int, y: int, data: bytes) -> None:
+        self.map.set_chunk(x, y, self.chunk_size, data)
+        self.clearance.invalidate(x * self.chunk_size, y * self.chunk_size,
+                                  (x + 1) * self.chunk_size, (y + 1) * self.chunk_size)
+        # borders at the edges of the neighbours depend on this chunk
+        for dx, dy in ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)):
+            self.geometry.pop((x + dx, y + dy), None)
+        self.visibility_key = None
+        self.line_of_sight = {}
+        chunk_length = self.chunk_size * self.tile_size
+        area = self.wall_layer_area
+        if area is not None and (x + 1) * chunk_length >= area.left and x * chunk_length <= area.right \
+                and (y + 1) * chunk_length >= area.top and y * chunk_length <= area.bottom:
+            self.wall_layer_area = None
+
+    def remove_player(self, uuid: str) -> None:
+        del self.players[uuid]
+        self.line_of_sight.pop(uuid, None)
+
+
+def view_rectangle(world: World, width: int, height: int, interpolation: float = 1.) -> Rectangle:
+    """
+    Return the part of the world shown in a view of the given size, the camera follows the own player.
+
+    interpolation is the fraction of the last simulation step that is shown.
+    """
+    x, y = world.player.interpolate(interpolation)
+    left = x - width / 2
+    top = y - height / 2
+    return Rectangle(left, left + width, top, top + height)
+
+
+def chunk_geometries(world: World, area: Rectangle) -> Iterator[WallGeometry]:
+    chunk_length = world.chunk_size * world.tile_size
+    columns, rows = world.map.chunk_count(world.chunk_size)
+    for chunk_y in range(max(0, int(area.top // chunk_length)), min(rows, int(area.bottom // chunk_length) + 1)):
+        for chunk_x in range(max(0, int(area.left // chunk_length)),
+                             min(columns, int(area.right // chunk_length) + 1)):
+            geometry = world.geometry.get((chunk_x, chunk_y))
+            if geometry is None:
+                geometry = world.geometry[chunk_x, chunk_y] = WallGeometry(world, chunk_x, chunk_y)
+            yield geometry
+
+
+def wall_rectangles(world: World, area: Rectangle) -> Iterator[Rectangle]:
+    for geometry in chunk_geometries(world, area):
+        for rectangle in geometry.rectangles:
+            if rectangle.right >= area.left and rectangle.left <= area.right \
+                    and rectangle.bottom >= area.top and rectangle.top <= area.bottom:
+                yield rectangle
+
+
+def wall_edges(world: World, area: Rectangle) -> Iterator[Tuple[float, float, float, float]]:
+    for geometry in chunk_geometries(world, area):
+        for edge in geometry.edges:
+            x1, y1, x2, y2 = edge
+            if x2 >= area.left and x1 <= area.right and y2 >= area.top and y1 <= area.bottom:
+                yield edge
+
+
+def visible_area(world: World, view: Rectangle) -> List[Tuple[float, float]]:
+    """
+    Return the polygon of the part of the view the player in its center can see, computed again only after the player
+    moved, the view was resized or the map changed.
+    """
+    key = (view.x, view.y, view.width, view.height)
+    if key != world.visibility_key:
+        world.visibility_polygon = visibility.visibility_polygon(
+            view.x, view.y, wall_edges(world, view), (view.left, view.top, view.right, view.bottom))
+        world.visibility_key = key
+    return world.visibility_polygon
+
+
+def draw_shadow(cr: cairo.Context, world: World, view: Rectangle) -> None:
+    polygon = visible_area(world, view)
+    width = int(math.ceil(view.width))
+    height = int(math.ceil(view.height))
+    if world.shadow_surface is None \
+            or (world.shadow_surface.get_width(), world.shadow_surface.get_height()) != (width, height):
+        world.shadow_surface = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+        world.shadow_polygon = None
+    if polygon is not world.shadow_polygon:
+        scr = cairo.Context(world.shadow_surface)
+        scr.set_operator(cairo.Operator.SOURCE)
+        scr.set_source_rgba(0, 0, 0, .6)
+        scr.paint()
+        # cut out the visible area
+        scr.set_operator(cairo.Operator.CLEAR)
+        scr.translate(-view.left, -view.top)
+        for i, point in enumerate(polygon):
+            if i == 0:
+                scr.move_to(*point)
+            else:
+                scr.line_to(*point)
+        scr.fill()
+        world.shadow_polygon = polygon
+    cr.set_source_surface(world.shadow_surface, view.left, view.top)
+    cr.paint()
+
+
+def draw_walls(cr: cairo.Context, world: World, view: Rectangle) -> None:
+    """
+    Draw the walls from a layer that covers the view and a margin around it, the layer is drawn again when the view
+    left it or its walls changed.
+    """
+    size = (int(math.ceil(view.width)) + 2 * WALL_LAYER_MARGIN, int(math.ceil(view.height)) + 2 * WALL_LAYER_MARGIN)
+    if size != world.wall_layer_size:
+        world.wall_layer = cr.get_target().create_similar(cairo.Content.COLOR_ALPHA, *size)
+        world.wall_layer_size = size
+        world.wall_layer_area = None
+    area = world.wall_layer_area
+    if area is None or view.left < area.left or view.right > area.right \
+            or view.top < area.top or view.bottom > area.bottom:
+        left = math.floor(view.left) - WALL_LAYER_MARGIN
+        top = math.floor(view.top) - WALL_LAYER_MARGIN
+        area = world.wall_layer_area = Rectangle(left, left + size[0], top, top + size[1])
+
+        lcr = cairo.Context(world.wall_layer)
+        lcr.set_operator(cairo.Operator.CLEAR)
+        lcr.paint()
+        lcr.set_operator(cairo.Operator.OVER)
+        lcr.translate(-area.left, -area.top)
+        lcr.set_line_width(1)
+        lcr.set_source_rgb(.9, 0, 0)
+        for rectangle in wall_rectangles(world, area):
+            lcr.rectangle(rectangle.left, rectangle.top, rectangle.width, rectangle.height)
+        lcr.fill()
+        lcr.set_source_rgb(0, 0, 0)
+        for x1, y1, x2, y2 in wall_edges(world, area):
+            lcr.move_to(x1, y1)
+            lcr.line_to(x2, y2)
+        lcr.stroke()
+    cr.set_source_surface(world.wall_layer, area.left, area.top)
+    cr.paint()
+
+
+def in_line_of_sight(world: World, uuid: str, player: Player) -> bool:
+    """
+    Test if no wall is between the own player and the other player, the result is kept until one of them moved.
+    """
+    key = (world.player.x, world.player.y, player.x, player.y)
+    cached = world.line_of_sight.get(uuid)
+    if cached is None or cached[0] != key:
+        visible = tilemap.line_of_sight(
+            world.map,
+            world.player.x / world.tile_size, world.player.y / world.tile_size,
+            player.x / world.tile_size, player.y / world.tile_size)
+        cached = world.line_of_sight[uuid] = (key, visible)
+    return cached[1]
+
+
+def draw(cr: cairo.Context, world: World, width: int, height: int, interpolation: float = 1.,
+         frame_profiler: Optional[profiler.FrameProfiler] = None) -> None:
+    """
+    Draw the view of the own player onto a surface of the given size, timing the passes with the profiler.
+    """
+    if not world.map or not world.player:
+        return
+    phase = frame_profiler.phase if frame_profiler is not None else profiler.no_phase
+
+    view = view_rectangle(world, width, height, interpolation)
+
+    with phase("clear"):
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+    # draw in world coordinates, walls outside of the view can't cast shadows into it
+    cr.translate(-view.left, -view.top)
+
+    # darken what the player can't see
+    with phase("shadow"):
+        draw_shadow(cr, world, view)
+
+    with phase("walls"):
+        draw_walls(cr, world, view)
+
+    for uuid, player in world.players.items():
+        if uuid == world.player_uuid:
+            continue
+        with phase("line of sight"):
+            visible = in_line_of_sight(world, uuid, player)
+        if visible:
+            with phase("players"):
+                draw_player(cr, player)
+
+    with phase("players"):
+        # the view is centered on the own player
+        draw_player(cr, Player(view.x, view.y, world.player.rotation, world.player.health))
+
+    with phase("bullets"):
+        draw_bullets(cr, world.bullets, interpolation)
+
+
+def draw_overlay(cr: cairo.Context, lines: List[str]) -> None:
+    """
+    Draw lines of text in the top left corner of the surface on a translucent background.
+    """
+    if not lines:
+        return
+    with save_context(cr):
+        cr.identity_matrix()
+        cr.select_font_face("monospace")
+        cr.set_font_size(12)
+        line_height = 15
+        width = max(cr.text_extents(line).x_advance for line in lines)
+        cr.set_source_rgba(0, 0, 0, .6)
+        cr.rectangle(0, 0, width + 10, len(lines) * line_height + 8)
+        cr.fill()
+        cr.set_source_rgb(1, 1, 1)
+        for i, line in enumerate(lines):
+            cr.move_to(5, 4 + (i + 1) * line_height - 3)
+            cr.show_text(line)
+
+
+def draw_player(cr: cairo.Context, player: Player) -> None:
+    with save_context(cr):
+        cr.translate(player.x, player.y)
+
+        with save_context(cr):
+            cr.rotate(player.rotation)
+
+            # draw player
+            cr.set_source_rgb(0, 0, 0)
+            cr.arc(0, 0, 10, 0, math.tau)
+            cr.fill()
+
+            # draw arms
+            cr.move_to(2, -10)
+            cr.rel_line_to(12, 0)
+            cr.move_to(2, 10)
+            cr.rel_line_to(12, 0)
+            cr.stroke()
+
+        # draw health
+        cr.set_source_rgb(1, 1, 1)
+        cr.rectangle(-20, -35, 40, 8)
+        cr.fill()
+        # cr.set_source_rgb(.1, .9, .2)
+        cr.set_source_rgb(2 * (1 - player.health), 2 * player.health, 0)
+        cr.rectangle(-20, -35, 40 * player.health, 8)
+        cr.fill()
+        cr.set_line_width(1)
+        cr.set_source_rgb(0, 0, 0)
+        cr.rectangle(-20, -35, 40, 8)
+        cr.stroke()
+
+
+def draw_bullets(cr: cairo.Context, bullets: Bullets, interpolation: float = 1.) -> None:
+    cr.set_source_rgb(.2, .2, .2)
+    for x, y in bullets.interpolate(interpolation).tolist():
+        cr.new_sub_path()
+        cr.arc(x, y, 1, 0, math.tau)
+    cr.fill()
+
+
+def render(world: World, width: int, height: int, interpolation: float = 1.) -> cairo.ImageSurface:
+    """
+    Draw the view of the own player onto a new image surface.
+    """
+    surface = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+    draw(cairo.Context(surface), world, width, height, interpolation)
+    surface.flush()
+    return surface
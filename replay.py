@@ -0,0 +1,313 @@
+"""
+Replay recordings written by ``server.py --record``
+
+``info`` summarizes a recording. ``client`` feeds the messages the server sent to one connection into a headless
+client, which keeps the snapshot states like the real client and prints the events it gets. ``server`` sends the
+messages the clients sent to a running server again, with one connection per recorded player. Replays start at the
+last keyframe before ``--start`` and run at ``--speed`` times the recorded speed, 0 for as fast as possible.
+
+A server replay faster than the recording exceeds the message rate the server accepts from a client, so the server
+has to run with ``--max-message-rate 0`` for it. Positions arriving faster than a player can walk are still
+corrected, only ``--speed 1`` reproduces the movement of the session.
+"""
+import argparse
+import asyncio
+import collections
+import time
+from typing import Dict, Iterator, Optional
+
+import protocol
+import recording
+
+
+def find_connection(keyframe: Optional[recording.Keyframe], records: Iterator[recording.Record],
+                    selector: Optional[str]) -> Optional[str]:
+    """
+    Return the uuid of the connection matching the selector (a player id or the start of a uuid) that is connected
+    at the keyframe or connects later, the first one if there is no selector.
+    """
+    def matches(player_id: int, uuid: str) -> bool:
+        return selector is None or selector == str(player_id) or uuid.startswith(selector)
+
+    if keyframe is not None:
+        for connection in keyframe.connections:
+            if matches(connection.id, connection.uuid):
+                return connection.uuid
+    for record in records:
+        if record.kind == recording.KIND_CONNECT and matches(record.connection, str(record.payload, "utf-8")):
+            return str(record.payload, "utf-8")
+    return None
+
+
+def read_keyframe(recording_file: recording.Recording, offset: int) -> Optional[recording.Keyframe]:
+    record = next(recording_file.records(offset), None)
+    if record is None or record.kind != recording.KIND_KEYFRAME:
+        return None
+    return recording.decode_keyframe(record.payload)
+
+
+class Clock:
+    """
+    Maps the times of the records to the wall clock, scaled by the speed.
+    """
+    def __init__(self, speed: float) -> None:
+        self.speed = speed
+        self.start_time: Optional[float] = None
+        self.start_record_time = 0.
+
+    def delay(self, record_time: float) -> float:
+        """
+        Return the seconds to wait until a record of the given time is due.
+        """
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+            self.start_record_time = record_time
+        if not self.speed:
+            return 0
+        return (record_time - self.start_record_time) / self.speed - (time.perf_counter() - self.start_time)
+
+
+def info(recording_file: recording.Recording) -> None:
+    kinds: Dict[int, int] = collections.Counter()
+    messages: Dict[str, int] = collections.Counter()
+    message_bytes: Dict[str, int] = collections.Counter()
+    last_time = 0.
+    for record in recording_file.records():
+        kinds[record.kind] += 1
+        last_time = record.time
+        if record.kind in (recording.KIND_IN, recording.KIND_OUT):
+            direction = "in" if record.kind == recording.KIND_IN else "out"
+            try:
+                message_type = recording.decode_message(record).get("type")
+            except ValueError:
+                message_type = "invalid"
+            messages[f"{direction}.{message_type}"] += 1
+            message_bytes[f"{direction}.{message_type}"] += len(record.payload)
+
+    print("settings:", recording_file.settings)
+    print(f"duration: {last_time:.1f} s, {len(recording_file.data)} bytes")
+    print(f"connections: {kinds[recording.KIND_CONNECT]}, keyframes: {kinds[recording.KIND_KEYFRAME]} "
+          f"({len(recording_file.index)} indexed)")
+    for name in sorted(messages):
+        print(f"{name:20} {messages[name]:10} messages {message_bytes[name]:12} bytes")
+
+
+class HeadlessClient:
+    """
+    Keeps the state of a client from the messages the server sent to it.
+    """
+    def __init__(self, connection: Optional[recording.ConnectionState], verbose: bool) -> None:
+        self.verbose = verbose
+        self.record_time = 0.
+        self.states: Dict[int, protocol.WorldState] = {0: {}}
+        self.tick = 0
+        if connection is not None:
+            self.states.update(connection.states)
+            self.tick = max(connection.states, default=0)
+        self.snapshots = 0
+        self.unknown_baselines = 0
+
+    def dispatch_message(self, message: dict) -> None:
+        message_type = message.pop("type")
+        handler = getattr(self, f"handle_{message_type}", None)
+        if handler:
+            handler(**message)
+        elif self.verbose:
+            print(f"{self.record_time:10.3f} {message_type} {message}")
+
+    def handle_snapshot(self, tick, baseline, input, joined, removed, players):
+        if tick <= self.tick:
+            return
+        if baseline not in self.states:
+            self.unknown_baselines += 1
+            return
+        state = protocol.apply_delta(self.states[baseline], joined, removed, players)
+        self.states[tick] = state
+        self.tick = tick
+        for old_tick in [old_tick for old_tick in self.states if old_tick < baseline]:
+            del self.states[old_tick]
+        self.snapshots += 1
+
+    def handle_chunk(self, x, y, tiles):
+        if self.verbose:
+            print(f"{self.record_time:10.3f} chunk {x} {y}")
+
+    def print_players(self) -> None:
+        for player_id, player_state in sorted(self.states[self.tick].items()):
+            x, y, rotation, health = protocol.dequantize_player(player_state)
+            print(f"player {player_id:3} {player_state[0]} x {x:8.1f} y {y:8.1f} health {health:.2f}")
+
+
+async def replay_client(recording_file: recording.Recording, args: argparse.Namespace) -> None:
+    offset = recording_file.seek(args.start)
+    keyframe = read_keyframe(recording_file, offset)
+    uuid = find_connection(keyframe, recording_file.records(offset), args.connection)
+    if uuid is None:
+        print("no matching connection")
+        return
+    connection = next((connection for connection in keyframe.connections if connection.uuid == uuid), None) \
+        if keyframe is not None else None
+    print("replaying connection", uuid)
+
+    client = HeadlessClient(connection, args.verbose)
+    # player ids are reused, so follow the id only while the uuid has it
+    player_id = connection.id if connection is not None else None
+    clock = Clock(args.speed)
+    start_time = time.perf_counter()
+    first_time = last_time = None
+    for record in recording_file.records(offset):
+        if record.kind == recording.KIND_CONNECT and str(record.payload, "utf-8") == uuid:
+            player_id = record.connection
+        elif record.connection != player_id or record.kind == recording.KIND_KEYFRAME:
+            continue
+        elif record.kind == recording.KIND_DISCONNECT:
+            break
+        elif record.kind == recording.KIND_OUT:
+            delay = clock.delay(record.time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            client.record_time = record.time
+            client.dispatch_message(recording.decode_message(record))
+        first_time = record.time if first_time is None else first_time
+        last_time = record.time
+
+    wall_time = time.perf_counter() - start_time
+    replayed_time = (last_time - first_time) if first_time is not None else 0
+    print(f"replayed {replayed_time:.1f} s in {wall_time:.2f} s ({replayed_time / max(wall_time, 1e-9):.0f}x), "
+          f"{client.snapshots} snapshots, {client.unknown_baselines} with an unknown baseline")
+    client.print_players()
+
+
+class ReplayConnection(asyncio.Protocol):
+    """
+    Connection to a server that sends the recorded messages of one player and acknowledges its own snapshots.
+    """
+    def __init__(self) -> None:
+        self.buffer = protocol.FrameBuffer()
+        self.transport: asyncio.WriteTransport = None
+        self.encoder = protocol.JsonCodec()
+        self.decoder = protocol.JsonCodec()
+        self.received_bytes = 0
+        self.closed = False
+
+    def send(self, **message) -> None:
+        if not self.closed:
+            self.transport.write(self.encoder.encode(message))
+
+    def connection_made(self, transport: asyncio.WriteTransport) -> None:
+        self.transport = transport
+        self.send(type="hello", formats=[protocol.BinaryCodec.name, protocol.JsonCodec.name])
+
+    def connection_lost(self, exc) -> None:
+        self.closed = True
+
+    def data_received(self, data: bytes) -> None:
+        self.received_bytes += len(data)
+        self.buffer.feed(data)
+        while True:
+            frame = self.decoder.next_frame(self.buffer)
+            if frame is None:
+                break
+            message = self.decoder.decode(frame)
+            if message["type"] == "format":
+                self.decoder = protocol.CODECS[message["format"]]()
+                self.send(type="format", format=message["format"])
+                self.encoder = protocol.CODECS[message["format"]]()
+            elif message["type"] == "snapshot":
+                self.send(type="ack", tick=message["tick"])
+
+
+async def replay_server(recording_file: recording.Recording, args: argparse.Namespace) -> None:
+    loop = asyncio.get_event_loop()
+    offset = recording_file.seek(args.start)
+    keyframe = read_keyframe(recording_file, offset)
+    uuids = {connection.id: connection.uuid for connection in keyframe.connections} if keyframe else {}
+    connections: Dict[int, ReplayConnection] = {}
+    opened_connections = 0
+
+    async def connect(player_id: int) -> ReplayConnection:
+        nonlocal opened_connections
+        _, connection = await loop.create_connection(ReplayConnection, args.host, args.port)
+        connections[player_id] = connection
+        opened_connections += 1
+        player = keyframe.players.get(uuids.get(player_id)) if keyframe else None
+        if player is not None:
+            # connected before the keyframe, start where the player was
+            connection.send(type="position", x=player[0], y=player[1], rotation=player[2])
+        return connection
+
+    clock = Clock(args.speed)
+    start_time = time.perf_counter()
+    sent_messages = 0
+    first_time = last_time = None
+    for record in recording_file.records(offset):
+        if record.kind not in (recording.KIND_CONNECT, recording.KIND_DISCONNECT, recording.KIND_IN):
+            continue
+        # even as fast as possible, the loop has to write the messages and read the snapshots in between
+        await asyncio.sleep(max(clock.delay(record.time), 0))
+        first_time = record.time if first_time is None else first_time
+        last_time = record.time
+        connection = connections.get(record.connection)
+        if record.kind == recording.KIND_CONNECT:
+            uuids[record.connection] = str(record.payload, "utf-8")
+            if connection is not None:
+                connection.transport.close()
+            await connect(record.connection)
+        elif record.kind == recording.KIND_DISCONNECT:
+            if connection is not None:
+                connection.transport.close()
+                del connections[record.connection]
+        else:
+            try:
+                message = recording.decode_message(record)
+            except ValueError:
+                continue
+            # the replay connections negotiate and acknowledge on their own
+            if message.get("type") in ("hello", "format", "register", "ack"):
+                continue
+            if connection is None:
+                connection = await connect(record.connection)
+            connection.send(**message)
+            sent_messages += 1
+
+    wall_time = time.perf_counter() - start_time
+    replayed_time = (last_time - first_time) if first_time is not None else 0
+    print(f"replayed {replayed_time:.1f} s in {wall_time:.2f} s ({replayed_time / max(wall_time, 1e-9):.0f}x), "
+          f"{sent_messages} messages over {opened_connections} connections")
+    for connection in connections.values():
+        connection.transport.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="replay recordings of the shooter2d server")
+    parser.add_argument("command", choices=["info", "client", "server"])
+    parser.add_argument("recording", help="file written by server.py --record")
+    parser.add_argument("--start", type=float, default=0,
+                        help="seconds into the recording, the replay starts at the keyframe before (default: start)")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay speed relative to the recording, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--connection", help="player id or start of the uuid of the connection to replay as client "
+                                             "(default: the first one)")
+    parser.add_argument("--verbose", action="store_true", help="print every event the client gets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5661)
+    args = parser.parse_args()
+
+    recording_file = recording.Recording(args.recording)
+    loop = asyncio.get_event_loop()
+    try:
+        if args.command == "info":
+            info(recording_file)
+        elif args.command == "client":
+            loop.run_until_complete(replay_client(recording_file, args))
+        else:
+            loop.run_until_complete(replay_server(recording_file, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+        recording_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,52 @@
+import argparse
 import asyncio
-import json
+import base64
+import heapq
+import itertools
+import math
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.reduction
+import os
+import random
+import secrets
+import socket
+import time
+import traceback
 import uuid
-from typing import Dict
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+import metrics
+import protocol
+import recording
+import tilemap
+
+# snapshots kept for a client that does not acknowledge them
+MAX_UNACKED_SNAPSHOTS = 64
+# players in a snapshot including the receiving one, the farthest are left out so it stays below the frame size
+MAX_SNAPSHOT_PLAYERS = 256
+
+# chunks of the map are squares of this many tiles, sent to clients when they get close
+CHUNK_SIZE = 32
+MAX_CHUNKS_PER_TICK = 8
+# largest view in pixels chunks are sent for, so a client can't ask for the whole map
+MAX_VIEW_SIZE = 8192
+# tile new players start on if it is free
+SPAWN_TILE = (8, 8)
+# new players start on a random free tile this many steps from the spawn tile, so they don't all see each other
+SPAWN_RADIUS = 16
+
+PLAYER_RADIUS = 10
+# pixels per second the players walk, as in the client
+MAX_SPEED = 70
+# factor players may walk faster than the speed by, for rounding and the jitter of the positions' arrival
+SPEED_TOLERANCE = 1.5
+# seconds of walking a player can save up and cover at once, standing still longer doesn't save up more
+MAX_WALK_SAVING = .5
+BULLET_SPEED = 500
+BULLET_DAMAGE = .1
+BULLET_LIFETIME = 2
 
 loop = asyncio.get_event_loop()
 
@@ -17,26 +62,89 @@ class Player:
         self.health = max(0, self.health - damage)
 
 
+class Bullet:
+    def __init__(self, shooter_uuid: str, x: float, y: float, vx: float, vy: float, tick: int) -> None:
+        self.shooter_uuid = shooter_uuid
+        self.x = x
+        self.y = y
+        self.vx = vx
+        self.vy = vy
+        self.spawn_tick = tick
+        # the bullet has been simulated up to this tick
+        self.tick = tick
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate messages per second on average and bursts of up to burst messages.
+    """
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = loop.time()
+
+    def allow(self) -> bool:
+        if not self.rate:
+            return True
+        now = loop.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class InterestGrid:
+    """
+    Uniform grid over the player positions to find the players near a point without looking at all players.
+    """
+    def __init__(self, cell_size: float) -> None:
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[str]] = defaultdict(set)
+        self.player_cells: Dict[str, Tuple[int, int]] = {}
+
+    def update(self, player_uuid: str, x: float, y: float) -> None:
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        old_cell = self.player_cells.get(player_uuid)
+        if old_cell == cell:
+            return
+        if old_cell is not None:
+            self.remove(player_uuid)
+        self.cells[cell].add(player_uuid)
+        self.player_cells[player_uuid] = cell
+
+    def remove(self, player_uuid: str) -> None:
+        cell = self.player_cells.pop(player_uuid)
+        self.cells[cell].discard(player_uuid)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def query(self, x: float, y: float, radius: float) -> Iterator[str]:
+        """
+        Yield the players in all cells touching the square around (x, y), callers check the exact distance.
+        """
+        left = int((x - radius) // self.cell_size)
+        right = int((x + radius) // self.cell_size)
+        top = int((y - radius) // self.cell_size)
+        bottom = int((y + radius) // self.cell_size)
+        if (right - left + 1) * (bottom - top + 1) > len(self.cells):
+            # the square covers more cells than there are occupied ones
+            for (cell_x, cell_y), uuids in self.cells.items():
+                if left <= cell_x <= right and top <= cell_y <= bottom:
+                    yield from uuids
+            return
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                yield from self.cells.get((cell_x, cell_y), ())
+
+
 class World:
-    def __init__(self):
-        self.map = [
-            "################",
-            "#              #",
-            "#              #",
-            "#  ##########  #",
-            "#  #        #  #",
-            "#  #        #  #",
-            "#  #  ####     #",
-            "#        #     #",
-            "#        ##  ###",
-            "##     ####    #",
-            "##     ####    #",
-            "##     ######  #",
-            "##     ######  #",
-            "####           #",
-            "####           #",
-            "################",
-        ]
+    def __init__(self, map: tilemap.TileMap, history_length: int) -> None:
+        self.map = map
+        # distance of the tiles to the walls, for checking that players don't walk through them
+        self.clearance = tilemap.ClearanceField(map)
         # self.map = [
         #     "     ",
         #     "     ",
@@ -53,104 +161,1025 @@ class World:
         #     Player(675, 383, -.8, .15),
         # ]
         self.players: Dict[str, Player] = {}
+        self.tick = 0
+        # size of a tile in the coordinates of the players, clients draw tiles with this size in pixels
+        self.tile_size = 50
+        self.interest_grid = InterestGrid(4 * self.tile_size)
+        self.bullets: List[Bullet] = []
+        # player positions after each of the last ticks, shots are rewound to the tick the shooter was seeing
+        self.history: Deque[Tuple[int, Dict[str, Tuple[float, float]]]] = deque(maxlen=history_length)
+        # tiles new players start on, found when the first player joins
+        self.spawn_tiles: Optional[List[Tuple[int, int]]] = None
+
+    def spawn_position(self) -> Tuple[float, float]:
+        """
+        Return the center of a random tile new players start on, one that can be reached from the spawn tile, or from
+        the first free tile after it if it is a wall.
+        """
+        if self.spawn_tiles is None:
+            start = SPAWN_TILE[1] * self.map.width + SPAWN_TILE[0]
+            index = next((i for i in itertools.chain(range(start, len(self.map.tiles)), range(start))
+                          if self.map.tiles[i] != tilemap.WALL), start)
+            y, x = divmod(index, self.map.width)
+            self.spawn_tiles = tilemap.reachable_tiles(self.map, x, y, SPAWN_RADIUS)
+        x, y = random.choice(self.spawn_tiles)
+        return (x + .5) * self.tile_size, (y + .5) * self.tile_size
 
 
 class ServerClientProtocol(asyncio.Protocol):
     def __init__(self) -> None:
         self.uuid = str(uuid.uuid4())
-        self.buffer = b""
+        self.id: int = None
+        self.buffer = protocol.FrameBuffer()
         self.transport: asyncio.WriteTransport = None
+        self.encoder = protocol.JsonCodec()
+        self.decoder = protocol.JsonCodec()
+        # latest position received since the last tick and its sequence number, applied by tick()
+        self.pending_position: Optional[Tuple[float, float, float]] = None
+        self.pending_sequence = 0
+        # sequence number of the last position applied, sent with the snapshots so the client can reconcile
+        self.input_sequence = 0
+        # loop time the last position was applied at and the distance the player may still walk
+        self.position_time = -math.inf
+        self.walk_budget = 0.
+        self.rate_limiter = RateLimiter(args.max_message_rate, args.max_message_burst)
+        self.rate_limited = False
+        self.received_messages = 0
+        self.dropped_messages = 0
+        self.superseded_positions = 0
+        self.corrected_positions = 0
+        # snapshot states sent but not acknowledged yet by tick, deltas are relative to the acknowledged baseline
+        self.sent_states: Dict[int, protocol.WorldState] = {}
+        self.last_sent_state: protocol.WorldState = {}
+        self.baseline_tick = 0
+        self.baseline_state: protocol.WorldState = {}
+        # input sequence numbers sent with the snapshots, like the states
+        self.sent_inputs: Dict[int, int] = {}
+        self.last_sent_input = 0
+        self.baseline_input = 0
+        # frames held back while the transport's write buffer is above its high-water mark
+        self.paused_since: Optional[float] = None
+        self.outbound: Deque[bytes] = deque()
+        self.outbound_size = 0
+        # newest snapshot state not sent because of the backpressure, it replaces any older one
+        self.unsent_state: Optional[protocol.WorldState] = None
+        self.closing = False
+        # datagram channel, used for positions, acks and snapshots once the client registered its address
+        self.datagram_token: Optional[str] = None
+        self.datagram_address: Optional[Tuple[str, int]] = None
+        self.received_sequence = 0
+        self.sent_sequence = 0
+        # chunks of the map sent to the client and the chunk of its player when all chunks around it were sent
+        self.sent_chunks: Set[Tuple[int, int]] = set()
+        self.chunk_center: Optional[Tuple[int, int]] = None
+        # size of the client's view in pixels, the chunks it covers are sent even beyond the view distance
+        self.view_size = (0, 0)
 
     def send(self, **message) -> None:
-        self.transport.write(json.dumps(message).encode() + b"\n")
+        if self.closing:
+            return
+        if self.paused_since is not None and message["type"] == "bullet":
+            # bullets are only drawn by the client, it would see them late and out of place
+            stats.count("messages_skipped.bullet")
+            return
+        data = self.encoder.encode(message)
+        stats.count(f"messages_out.{message['type']}")
+        stats.count(f"bytes_out.{message['type']}", len(data))
+        if recorder is not None:
+            recorder.record_frame(recording.KIND_OUT, self.encoder.name, self.id, data)
+        if self.paused_since is None:
+            self.transport.write(data)
+            return
+        self.outbound.append(data)
+        self.outbound_size += len(data)
+        if self.outbound_size > args.max_outbound_queue:
+            self.disconnect(f"outbound queue exceeds {args.max_outbound_queue} bytes")
 
-    def send_others(self, **message) -> None:
-        for client in clients.values():
-            if client is not self:
-                client.send(**message)
+    def send_datagram(self, **message) -> bool:
+        """
+        Send the message over the datagram channel, return False if it is too large for a datagram.
+        """
+        if self.closing:
+            # the client is gone or going, nothing needs to go over the stream instead
+            return True
+        data = datagram_endpoint.codec.encode(self.sent_sequence + 1, message)
+        if len(data) > protocol.MAX_DATAGRAM_SIZE:
+            stats.count("datagrams_too_large")
+            return False
+        self.sent_sequence += 1
+        datagram_endpoint.transport.sendto(data, self.datagram_address)
+        if recorder is not None:
+            recorder.record(recording.KIND_OUT, recording.CODEC_DATAGRAM, self.id, data)
+        stats.count(f"messages_out.{message['type']}")
+        stats.count(f"bytes_out.{message['type']}", len(data))
+        stats.count("datagrams_out")
+        return True
+
+    def send_chunks(self) -> None:
+        """
+        Send the chunks of the map within the view distance that the client doesn't have yet, nearest first and
+        only a few per tick, so neither joining nor crossing into new parts of a big map causes a burst.
+        """
+        player = world.players[self.uuid]
+        chunk_length = CHUNK_SIZE * world.tile_size
+        center_x = int(player.x // chunk_length)
+        center_y = int(player.y // chunk_length)
+        if (center_x, center_y) == self.chunk_center or self.paused_since is not None:
+            return
+        # the view is centered on the player, a tile more covers the client predicting its player a little ahead
+        radius_x, radius_y = (math.ceil(max(args.view_distance, size / 2 + world.tile_size) / chunk_length)
+                              for size in self.view_size)
+        columns, rows = world.map.chunk_count(CHUNK_SIZE)
+        missing = [
+            (x, y)
+            for y in range(max(0, center_y - radius_y), min(rows, center_y + radius_y + 1))
+            for x in range(max(0, center_x - radius_x), min(columns, center_x + radius_x + 1))
+            if (x, y) not in self.sent_chunks
+        ]
+        missing.sort(key=lambda chunk: (chunk[0] - center_x)**2 + (chunk[1] - center_y)**2)
+        for x, y in missing[:MAX_CHUNKS_PER_TICK]:
+            self.sent_chunks.add((x, y))
+            tiles = base64.b64encode(world.map.get_chunk(x, y, CHUNK_SIZE)).decode()
+            self.send(type="chunk", x=x, y=y, tiles=tiles)
+        if len(missing) <= MAX_CHUNKS_PER_TICK:
+            self.chunk_center = (center_x, center_y)
+
+    def pause_writing(self) -> None:
+        self.paused_since = loop.time()
+        stats.count("writes_paused")
+
+    def resume_writing(self) -> None:
+        if self.closing:
+            return
+        stats.observe("writes_paused_seconds", loop.time() - self.paused_since)
+        self.paused_since = None
+        # writing may pause the transport again, the rest stays queued until it resumes
+        while self.outbound and self.paused_since is None:
+            data = self.outbound.popleft()
+            self.outbound_size -= len(data)
+            self.transport.write(data)
+        if self.unsent_state is not None and self.paused_since is None:
+            state = self.unsent_state
+            self.unsent_state = None
+            self.send_snapshot(state)
+
+    def disconnect(self, reason: str) -> None:
+        print(self.uuid, f"disconnecting slow client: {reason}")
+        stats.count("slow_client_disconnects")
+        self.closing = True
+        self.outbound.clear()
+        self.outbound_size = 0
+        # don't wait for the buffered data to drain, the client doesn't read it fast enough
+        self.transport.abort()
 
-    def send_all(self, **message) -> None:
-        for client in clients.values():
-            client.send(**message)
+    def send_snapshot(self, state: protocol.WorldState) -> None:
+        if self.closing:
+            return
+        if self.datagram_address is not None:
+            if state == self.baseline_state and self.input_sequence == self.baseline_input:
+                # datagrams get lost, so the state is sent until the client acknowledges it
+                return
+        elif self.paused_since is not None:
+            # deltas are relative to the acknowledged baseline, so the newest one makes all older ones obsolete
+            if self.unsent_state is not None:
+                stats.count("snapshots_replaced")
+            self.unsent_state = state
+            return
+        elif state == self.last_sent_state and self.input_sequence == self.last_sent_input:
+            # the stream is reliable, so the client already has this state
+            return
+        message = dict(type="snapshot", tick=world.tick, baseline=self.baseline_tick, input=self.input_sequence,
+                       **protocol.diff_states(self.baseline_state, state))
+        if self.datagram_address is None or not self.send_datagram(**message):
+            self.send(**message)
+        self.last_sent_state = state
+        self.last_sent_input = self.input_sequence
+        self.sent_states[world.tick] = state
+        self.sent_inputs[world.tick] = self.input_sequence
+        if len(self.sent_states) > MAX_UNACKED_SNAPSHOTS:
+            del self.sent_states[next(iter(self.sent_states))]
+            del self.sent_inputs[next(iter(self.sent_inputs))]
 
     def connection_made(self, transport: asyncio.WriteTransport) -> None:
         self.transport = transport
+        self.transport.set_write_buffer_limits(args.write_buffer_limit)
         print(self.uuid, "connected")
+        stats.count("connections")
+        self.id = allocate_player_id()
+        if recorder is not None:
+            recorder.record(recording.KIND_CONNECT, 0, self.id, self.uuid.encode())
         clients[self.uuid] = self
-        world.players[self.uuid] = Player(400, 400, 0, 1)
+        x, y = world.spawn_position()
+        world.players[self.uuid] = Player(x, y, 0, 1)
+        world.interest_grid.update(self.uuid, x, y)
+        report_players()
 
-        # send initial data
-        self.send(type="world", map=world.map)
+        # send initial data, the map follows in chunks
+        self.send(type="world", width=world.map.width, height=world.map.height,
+                  tile_size=world.tile_size, chunk_size=CHUNK_SIZE, tick_rate=args.tick_rate)
         self.send(type="uuid", uuid=self.uuid)
 
-        self.send_all(type="players", players={
-            uuid: (player.x, player.y, player.rotation, player.health) for uuid, player in world.players.items()
-        })
-
     def connection_lost(self, exc):
-        print("connection lost")
+        self.closing = True
+        print(self.uuid, f"connection lost ({self.received_messages} messages received, "
+                         f"{self.dropped_messages} dropped by the rate limit, "
+                         f"{self.superseded_positions} positions superseded, "
+                         f"{self.corrected_positions} corrected)")
+        if recorder is not None:
+            recorder.record(recording.KIND_DISCONNECT, 0, self.id, b"")
+        if self.datagram_token is not None:
+            datagram_endpoint.unregister(self)
         del clients[self.uuid]
         del world.players[self.uuid]
-
-        self.send_all(type="players", players={
-            uuid: (player.x, player.y, player.rotation, player.health) for uuid, player in world.players.items()
-        })
+        world.interest_grid.remove(self.uuid)
+        report_players()
 
     def data_received(self, data: bytes) -> None:
-        self.buffer += data
+        stats.count("bytes_in", len(data))
+        self.buffer.feed(data)
 
-        while b"\n" in self.buffer:
-            line, self.buffer = self.buffer.split(b"\n", 1)
+        while True:
+            # read one frame at a time, a handler may switch the decoder for the following frames
             try:
-                message = json.loads(line.decode())
-                if not isinstance(message, dict):
-                    raise json.JSONDecodeError
-            except (UnicodeDecodeError, json.JSONDecodeError):
-                print(self.uuid, f"received invalid data: {line!r}")
-                self.send(type="error", error="invalid data")
+                frame = self.decoder.next_frame(self.buffer)
+            except protocol.FrameTooLarge as e:
+                print(self.uuid, f"closing connection: {e}")
+                self.send(type="error", error=str(e))
+                self.closing = True
+                self.transport.close()
+                return
+            if frame is None:
+                break
+            if recorder is not None:
+                recorder.record_frame(recording.KIND_IN, self.decoder.name, self.id, frame)
+            self.received_messages += 1
+            allowed = self.rate_limiter.allow()
+            if allowed:
+                self.rate_limited = False
+            elif not self.rate_limited:
+                print(self.uuid, "exceeds the message rate limit")
+                self.rate_limited = True
+            try:
+                message = self.decoder.decode(frame)
+            except ValueError:
+                if allowed:
+                    print(self.uuid, f"received invalid data: {bytes(frame)!r}")
+                    self.send(type="error", error="invalid data")
+                continue
+            message_type = message.get("type")
+            if not isinstance(message_type, str) or not hasattr(self, f"handle_{message_type}"):
+                # don't let clients create arbitrary metrics
+                message_type = "invalid"
+            stats.count(f"messages_in.{message_type}")
+            stats.count(f"bytes_in.{message_type}", len(frame))
+            if not allowed:
+                if message_type == "position":
+                    # positions only replace the pending one and cost nothing, everything else is dropped
+                    self.store_position(message)
+                else:
+                    self.dropped_messages += 1
+                    stats.count("messages_dropped")
                 continue
+            self.dispatch_message(message)
+
+    def datagram_received(self, sequence: int, message: dict, size: int) -> None:
+        if sequence <= self.received_sequence:
+            # an older datagram arrived late, a newer position or ack has already been handled
+            stats.count("datagrams_stale")
+            return
+        self.received_sequence = sequence
+        message_type = message.get("type")
+        if message_type not in ("position", "ack"):
+            # everything else is only accepted over the stream
+            stats.count("datagrams_invalid")
+            return
+        self.received_messages += 1
+        stats.count(f"messages_in.{message_type}")
+        stats.count(f"bytes_in.{message_type}", size)
+        if not self.rate_limiter.allow():
+            if message_type == "position":
+                self.store_position(message)
+            else:
+                self.dropped_messages += 1
+                stats.count("messages_dropped")
+            return
+        self.dispatch_message(message)
 
-            print("message:", message)
+    def store_position(self, message: dict) -> None:
+        """
+        Apply a position received above the rate limit if it is well-formed, without answering anything.
+        """
+        fields = {key: value for key, value in message.items() if key != "type"}
+        if {"x", "y", "rotation"} <= fields.keys() <= {"x", "y", "rotation", "sequence"}:
+            self.handle_position(**fields)
 
-            message_type = message.pop("type", None)
-            if isinstance(message_type, str):
-                handler = getattr(self, f"handle_{message_type}", None)
-                if handler:
-                    try:
-                        handler(**message)
-                    except TypeError as e:
-                        self.send(type="error", error=f"invalid handler arguments: {e}")
-                else:
-                    self.send(type="error", error=f"invalid message type: {message_type!r}")
+    def dispatch_message(self, message: dict) -> None:
+        message_type = message.pop("type", None)
+        if isinstance(message_type, str):
+            handler = getattr(self, f"handle_{message_type}", None)
+            if handler:
+                start_time = time.perf_counter()
+                try:
+                    handler(**message)
+                except TypeError as e:
+                    self.send(type="error", error=f"invalid handler arguments: {e}")
+                stats.observe(f"handler_seconds.{message_type}", time.perf_counter() - start_time)
             else:
-                self.send(type="error", error="invalid message: type missing")
-
-    def handle_position(self, x, y, rotation):
-        if isinstance(x, float) and isinstance(y, float) and isinstance(rotation, float):
-            world.players[self.uuid].x = x
-            world.players[self.uuid].y = y
-            world.players[self.uuid].rotation = rotation
-            self.send_others(type="position", uuid=self.uuid, x=x, y=y, rotation=rotation)
-
-    def handle_hit(self, uuid, strength):
-        if uuid in world.players:
-            player = world.players[uuid]
-            player.hit(strength)
-            self.send_all(type="health", uuid=uuid, health=player.health)
+                self.send(type="error", error=f"invalid message type: {message_type!r}")
         else:
-            self.send(type="error", error=f"unknown uuid: {uuid!r}")
+            self.send(type="error", error="invalid message: type missing")
+
+    def handle_hello(self, formats, udp=False):
+        if not isinstance(formats, list):
+            self.send(type="error", error="invalid formats")
+            return
+        for name in formats:
+            if name in protocol.CODECS and (name == protocol.JsonCodec.name or not args.json_only):
+                self.send(type="format", format=name)
+                self.encoder = protocol.CODECS[name]()
+                break
+        else:
+            self.send(type="error", error=f"no supported format in {formats!r}")
+        if udp is True and datagram_endpoint is not None and self.datagram_token is None:
+            self.datagram_token = secrets.token_hex(16)
+            datagram_endpoint.tokens[self.datagram_token] = self
+            self.send(type="udp", port=datagram_endpoint.port, token=self.datagram_token)
+
+    def handle_format(self, format):
+        if format in protocol.CODECS:
+            self.decoder = protocol.CODECS[format]()
+        else:
+            self.send(type="error", error=f"unknown format: {format!r}")
+
+    def handle_position(self, x, y, rotation, sequence=0):
+        if not all(isinstance(value, float) and math.isfinite(value) for value in (x, y, rotation)):
+            # json and the binary floats allow NaN and infinity, which would break the simulation
+            return
+        if not isinstance(sequence, int) or not 0 <= sequence <= protocol.MAX_SEQUENCE:
+            return
+        if sequence and sequence <= self.pending_sequence:
+            # older than a position already applied, unnumbered positions (0) keep the sequence number
+            return
+        if self.pending_position is not None:
+            self.superseded_positions += 1
+        self.pending_position = (x, y, rotation)
+        if sequence:
+            self.pending_sequence = sequence
+
+    def handle_view(self, width, height):
+        if not all(isinstance(size, int) and not isinstance(size, bool) and size >= 0 for size in (width, height)):
+            self.send(type="error", error="invalid view size")
+            return
+        self.view_size = (min(width, MAX_VIEW_SIZE), min(height, MAX_VIEW_SIZE))
+        # look for missing chunks again, even if the player stays in its chunk
+        self.chunk_center = None
+
+    def handle_ack(self, tick):
+        state = self.sent_states.get(tick)
+        if state is None:
+            # already superseded by a newer acknowledgement
+            return
+        self.baseline_tick = tick
+        self.baseline_state = state
+        self.baseline_input = self.sent_inputs[tick]
+        for sent_tick in [sent_tick for sent_tick in self.sent_states if sent_tick <= tick]:
+            del self.sent_states[sent_tick]
+            del self.sent_inputs[sent_tick]
+
+    def handle_shoot(self, rotation, tick):
+        # like positions, rotations are floats, json integers can be too large to convert to one
+        if (not isinstance(rotation, float) or not math.isfinite(rotation)
+                or not isinstance(tick, int) or isinstance(tick, bool)):
+            self.send(type="error", error="invalid shot")
+            return
+        shooter = world.players[self.uuid]
+        # rewind to the snapshot the shooter was seeing, as far as the history reaches
+        oldest_tick = world.history[0][0] if world.history else world.tick
+        tick = min(max(tick, oldest_tick), world.tick)
+        bullet = Bullet(self.uuid, shooter.x, shooter.y,
+                        BULLET_SPEED * math.cos(rotation), BULLET_SPEED * math.sin(rotation), tick)
+        for client in observers(self.uuid):
+            if client is not self:
+                client.send(type="bullet", uuid=self.uuid, x=bullet.x, y=bullet.y, vx=bullet.vx, vy=bullet.vy)
+
+        for past_tick, positions in list(world.history):
+            if past_tick > tick and not advance_bullet(bullet, positions):
+                return
+        world.bullets.append(bullet)
+
+
+class ServerDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram channel of a room, it hands the datagrams of registered addresses to their clients.
+
+    Clients register their address with the token they got over the stream, so nobody can inject positions for
+    another player without having its stream.
+    """
+    def __init__(self) -> None:
+        self.transport: asyncio.DatagramTransport = None
+        self.port: int = None
+        self.codec = protocol.DatagramCodec()
+        self.tokens: Dict[str, ServerClientProtocol] = {}
+        self.addresses: Dict[Tuple[str, int], ServerClientProtocol] = {}
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.port = transport.get_extra_info("sockname")[1]
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]) -> None:
+        stats.count("datagrams_in")
+        stats.count("bytes_in", len(data))
+        try:
+            sequence, message = self.codec.decode(data)
+        except ValueError:
+            stats.count("datagrams_invalid")
+            return
+        if message.get("type") == "register":
+            self.register(message.get("token"), address)
+            return
+        client = self.addresses.get(address)
+        if client is None:
+            stats.count("datagrams_unknown")
+            return
+        if recorder is not None:
+            recorder.record(recording.KIND_IN, recording.CODEC_DATAGRAM, client.id, data)
+        client.datagram_received(sequence, message, len(data))
+
+    def error_received(self, exc: Exception) -> None:
+        # e.g. an ICMP port unreachable of a client that went away, its stream tells us when it is gone
+        stats.count("datagram_errors")
+
+    def register(self, token: str, address: Tuple[str, int]) -> None:
+        client = self.tokens.get(token) if isinstance(token, str) else None
+        if client is None:
+            stats.count("datagrams_unknown")
+            return
+        if client.datagram_address != address:
+            self.addresses.pop(client.datagram_address, None)
+            client.datagram_address = address
+            self.addresses[address] = client
+            print(client.uuid, "registered datagram address", address)
+        # answer every registration, the client retries until it gets an answer
+        client.send_datagram(type="registered")
+
+    def unregister(self, client: ServerClientProtocol) -> None:
+        del self.tokens[client.datagram_token]
+        self.addresses.pop(client.datagram_address, None)
+
+
+def open_datagram_endpoint(port: int) -> None:
+    global datagram_endpoint
+    _, datagram_endpoint = loop.run_until_complete(
+        loop.create_datagram_endpoint(ServerDatagramProtocol, local_addr=("127.0.0.1", port)))
+
+
+def observers(observed_uuid: str) -> Iterator[ServerClientProtocol]:
+    """
+    Yield the observed player's client and all clients that currently receive its state.
+    """
+    observed_id = clients[observed_uuid].id
+    for player_uuid, client in clients.items():
+        if player_uuid == observed_uuid or observed_id in client.last_sent_state:
+            yield client
+
+
+def send_observers(observed_uuid: str, **message) -> None:
+    for client in observers(observed_uuid):
+        client.send(**message)
+
+
+def allocate_player_id() -> int:
+    """
+    Return the smallest player id not used by a connected client, snapshots reference players by these ids.
+    """
+    used = {client.id for client in clients.values()}
+    player_id = 1
+    while player_id in used:
+        player_id += 1
+    return player_id
+
+
+def observed_players(viewer_uuid: str) -> Iterator[str]:
+    """
+    Yield the viewer and the players it can plausibly see: within the view distance and, if enabled, not hidden
+    behind walls. Only the nearest of them are yielded if there are more than fit in a snapshot.
+    """
+    viewer = world.players[viewer_uuid]
+    yield viewer_uuid
+    candidates = []
+    for player_uuid in world.interest_grid.query(viewer.x, viewer.y, args.view_distance):
+        if player_uuid == viewer_uuid:
+            continue
+        player = world.players[player_uuid]
+        distance = (player.x - viewer.x)**2 + (player.y - viewer.y)**2
+        if distance <= args.view_distance**2:
+            candidates.append((distance, player_uuid))
+    if len(candidates) >= MAX_SNAPSHOT_PLAYERS:
+        stats.count("snapshot_players_left_out", len(candidates) - MAX_SNAPSHOT_PLAYERS + 1)
+        candidates = heapq.nsmallest(MAX_SNAPSHOT_PLAYERS - 1, candidates)
+    for _, player_uuid in candidates:
+        player = world.players[player_uuid]
+        if args.line_of_sight and not tilemap.line_of_sight(
+                world.map,
+                viewer.x / world.tile_size, viewer.y / world.tile_size,
+                player.x / world.tile_size, player.y / world.tile_size):
+            continue
+        yield player_uuid
+
 
+def segment_hits_circle(start_x: float, start_y: float, dx: float, dy: float,
+                        center_x: float, center_y: float, radius: float) -> Optional[float]:
+    """
+    Return the fraction of the segment at which it enters the circle, None if it misses the circle.
+    """
+    fx = start_x - center_x
+    fy = start_y - center_y
+    c = fx**2 + fy**2 - radius**2
+    if c <= 0:
+        return 0
+    a = dx**2 + dy**2
+    b = 2 * (fx * dx + fy * dy)
+    discriminant = b**2 - 4 * a * c
+    if a == 0 or discriminant < 0:
+        return None
+    t = (-b - discriminant**.5) / (2 * a)
+    return t if 0 <= t <= 1 else None
 
-world = World()
 
+def advance_bullet(bullet: Bullet, positions: Optional[Dict[str, Tuple[float, float]]] = None) -> bool:
+    """
+    Move the bullet by one tick and apply its hit, return whether it is still flying.
+
+    positions are the rewound player positions of the tick, the current positions are used if they are None.
+    """
+    dx = bullet.vx / args.tick_rate
+    dy = bullet.vy / args.tick_rate
+    if positions is None:
+        reach = (dx**2 + dy**2)**.5 / 2 + PLAYER_RADIUS
+        positions = {
+            player_uuid: (world.players[player_uuid].x, world.players[player_uuid].y)
+            for player_uuid in world.interest_grid.query(bullet.x + dx / 2, bullet.y + dy / 2, reach)
+        }
+
+    hit_t = tilemap.raycast(
+        world.map,
+        bullet.x / world.tile_size, bullet.y / world.tile_size,
+        (bullet.x + dx) / world.tile_size, (bullet.y + dy) / world.tile_size)
+    hit_uuid = None
+    for player_uuid, (x, y) in positions.items():
+        if player_uuid == bullet.shooter_uuid:
+            continue
+        t = segment_hits_circle(bullet.x, bullet.y, dx, dy, x, y, PLAYER_RADIUS)
+        if t is not None and (hit_t is None or t < hit_t):
+            hit_t = t
+            hit_uuid = player_uuid
+
+    bullet.x += dx
+    bullet.y += dy
+    bullet.tick += 1
+
+    # the player may have left while the shot was rewound
+    if hit_uuid in world.players:
+        player = world.players[hit_uuid]
+        player.hit(BULLET_DAMAGE)
+        send_observers(hit_uuid, type="health", uuid=hit_uuid, health=player.health)
+    return hit_t is None and bullet.tick - bullet.spawn_tick < BULLET_LIFETIME * args.tick_rate
+
+
+def walk(player: Player, x: float, y: float, max_distance: float) -> Tuple[float, float]:
+    """
+    Return where the player gets walking from its position towards a reported one, at most max_distance and sliding
+    along the walls in the way. That is exactly the reported position unless a wall is in the way or it is too far.
+    """
+    dx = x - player.x
+    dy = y - player.y
+    distance = (dx**2 + dy**2)**.5
+    too_far = distance > max_distance
+    if too_far:
+        dx *= max_distance / distance
+        dy *= max_distance / distance
+    end_x, end_y, blocked = tilemap.move_circle(
+        world.clearance, player.x / world.tile_size, player.y / world.tile_size, PLAYER_RADIUS / world.tile_size,
+        dx / world.tile_size, dy / world.tile_size)
+    if not blocked and not too_far:
+        return x, y
+    return end_x * world.tile_size, end_y * world.tile_size
+
+
+def tick() -> None:
+    """
+    Advance the simulation by one step and send every client a single delta snapshot of the players it observes.
+    """
+    world.tick += 1
+
+    now = loop.time()
+    for player_uuid, client in clients.items():
+        if client.pending_position is None:
+            continue
+        player = world.players[player_uuid]
+        x, y, player.rotation = client.pending_position
+        # the budget fills up with the time, not the ticks, as ticks are skipped when the server is behind
+        client.walk_budget = min(client.walk_budget + (now - client.position_time) * MAX_SPEED * SPEED_TOLERANCE,
+                                 MAX_WALK_SAVING * MAX_SPEED * SPEED_TOLERANCE)
+        client.position_time = now
+        start_x, start_y = player.x, player.y
+        player.x, player.y = walk(player, x, y, max(client.walk_budget, 0.))
+        client.walk_budget -= ((player.x - start_x)**2 + (player.y - start_y)**2)**.5
+        if (player.x, player.y) != (x, y):
+            client.corrected_positions += 1
+        client.pending_position = None
+        client.input_sequence = client.pending_sequence
+        world.interest_grid.update(player_uuid, player.x, player.y)
+    world.history.append((world.tick, {player_uuid: (player.x, player.y)
+                                       for player_uuid, player in world.players.items()}))
+
+    world.bullets = [bullet for bullet in world.bullets if advance_bullet(bullet)]
+
+    if recorder is not None and world.tick % max(1, round(args.keyframe_interval * args.tick_rate)) == 0:
+        record_keyframe()
+
+    states = {
+        player_uuid: protocol.quantize_player(player_uuid, player.x, player.y, player.rotation, player.health)
+        for player_uuid, player in world.players.items()
+    }
+    for player_uuid, client in clients.items():
+        if client.paused_since is not None and now - client.paused_since > args.slow_client_timeout:
+            client.disconnect(f"not reading for {now - client.paused_since:.1f} seconds")
+        try:
+            client.send_chunks()
+            client.send_snapshot({clients[observed_uuid].id: states[observed_uuid]
+                                  for observed_uuid in observed_players(player_uuid)})
+        except Exception:
+            # the clients after this one still get their snapshots
+            traceback.print_exc()
+            stats.count("snapshot_errors")
+
+
+def record_keyframe() -> None:
+    """
+    Record the players and the snapshot states of every client, so replays can start here.
+    """
+    recorder.keyframe(recording.Keyframe(
+        world.tick,
+        {player_uuid: (player.x, player.y, player.rotation, player.health)
+         for player_uuid, player in world.players.items()},
+        [recording.ConnectionState(client.id, client.uuid, client.baseline_tick,
+                                   {client.baseline_tick: client.baseline_state, **client.sent_states})
+         for client in clients.values()],
+    ))
+
+
+def start_recording(path: str) -> None:
+    global recorder
+    recorder = recording.Recorder(path, {
+        "map": os.path.abspath(args.map),
+        "tick_rate": args.tick_rate,
+        "tile_size": world.tile_size,
+        "chunk_size": CHUNK_SIZE,
+    })
+    print("recording to", path)
+
+
+async def run_ticks(tick_rate: float) -> None:
+    interval = 1 / tick_rate
+    next_tick_time = loop.time()
+    while True:
+        start_time = time.perf_counter()
+        try:
+            tick()
+        except Exception:
+            # whatever a client sent, the game goes on for everybody else
+            traceback.print_exc()
+            stats.count("tick_errors")
+        stats.observe("tick_seconds", time.perf_counter() - start_time)
+        stats.set("clients", len(clients))
+        stats.set("bullets", len(world.bullets))
+        write_buffer_sizes = [client.transport.get_write_buffer_size() for client in clients.values()]
+        for size in write_buffer_sizes:
+            stats.observe("write_buffer_bytes", size, metrics.SIZE_BUCKETS)
+        stats.set("write_buffer_bytes_max", max(write_buffer_sizes, default=0))
+        stats.set("outbound_queue_bytes", sum(client.outbound_size for client in clients.values()))
+        stats.set("paused_clients", sum(client.paused_since is not None for client in clients.values()))
+
+        next_tick_time += interval
+        delay = next_tick_time - loop.time()
+        if delay < 0:
+            # we are running behind, skip the missed ticks instead of trying to catch up in a burst
+            next_tick_time = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
+
+async def monitor_loop_lag(interval: float = .1) -> None:
+    """
+    Measure how late the event loop wakes up a sleeping task, a busy loop delays everything it runs.
+    """
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(interval)
+        stats.observe("loop_lag_seconds", loop.time() - start_time - interval)
+
+
+async def dump_stats(path: str, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        with open(path, "a") as f:
+            f.write(stats.to_json() + "\n")
+
+
+async def serve_stats(port: int) -> None:
+    server = await loop.create_server(StatsProtocol, "127.0.0.1", port)
+    try:
+        await loop.create_future()
+    finally:
+        server.close()
+
+
+class StatsProtocol(asyncio.Protocol):
+    """
+    Minimal HTTP endpoint answering every request with the metrics as JSON.
+    """
+    def connection_made(self, transport: asyncio.WriteTransport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        body = stats.to_json().encode()
+        self.transport.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+        self.transport.close()
+
+
+def start_instrumentation(stats_port: Optional[int], stats_file: Optional[str]) -> List[asyncio.Task]:
+    """
+    Start measuring the event loop lag and publishing the metrics, return the tasks to cancel on shutdown.
+    """
+    tasks = [loop.create_task(monitor_loop_lag())]
+    if stats_port:
+        tasks.append(loop.create_task(serve_stats(stats_port)))
+    if stats_file:
+        tasks.append(loop.create_task(dump_stats(stats_file, args.stats_interval)))
+    return tasks
+
+
+def report_players() -> None:
+    """
+    Tell the lobby how many sockets this room received and how many players are in it, counting those still
+    connecting, if the room runs in a worker process.
+    """
+    if lobby_connection is not None:
+        lobby_connection.send((received_handoffs, len(clients) + connecting_clients))
+
+
+def run_room(room_args: argparse.Namespace, connection: multiprocessing.connection.Connection, index: int) -> None:
+    """
+    Run a room in a worker process, the lobby hands the sockets of the clients over the connection.
+    """
+    global args, world, loop, lobby_connection
+    args = room_args
+    lobby_connection = connection
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    world = World(tilemap.TileMap.load(args.map), history_length=math.ceil(args.max_rewind * args.tick_rate) + 1)
+
+    def receive_client() -> None:
+        global received_handoffs, connecting_clients
+        try:
+            fd = multiprocessing.reduction.recv_handle(connection)
+        except (EOFError, OSError, RuntimeError):
+            print("lobby closed the connection")
+            loop.stop()
+            return
+        received_handoffs += 1
+        connecting_clients += 1
+        client_socket = socket.socket(fileno=fd)
+        task = loop.create_task(loop.connect_accepted_socket(ServerClientProtocol, client_socket))
+        task.add_done_callback(client_connected)
+        report_players()
+
+    def client_connected(task: asyncio.Task) -> None:
+        global connecting_clients
+        connecting_clients -= 1
+        report_players()
+
+    loop.add_reader(connection.fileno(), receive_client)
+    if args.udp:
+        open_datagram_endpoint(args.udp_port and args.udp_port + index)
+    if args.record:
+        start_recording(f"{args.record}.room-{index}")
+    tasks = [loop.create_task(run_ticks(args.tick_rate))]
+    # every room publishes its own metrics next to the ones of the lobby
+    tasks += start_instrumentation(
+        args.stats_port and args.stats_port + 1 + index,
+        args.stats_file and f"{args.stats_file}.room-{index}")
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    for task in tasks:
+        task.cancel()
+    if datagram_endpoint is not None:
+        datagram_endpoint.transport.close()
+    if recorder is not None:
+        recorder.close()
+    loop.remove_reader(connection.fileno())
+    loop.close()
+
+
+class Room:
+    """
+    Worker process running a room, as seen by the lobby.
+    """
+    def __init__(self, process: multiprocessing.process.BaseProcess, connection: multiprocessing.connection.Connection) -> None:
+        self.process = process
+        self.connection = connection
+        # players as reported by the room, they include the handoffs it received
+        self.players = 0
+        # connections handed over to the room and how many of them the room reported as received
+        self.handoffs = 0
+        self.received_handoffs = 0
+        # the lobby hands no more connections to a room whose process is gone
+        self.stopped = False
+
+    def load(self) -> int:
+        """
+        Return the players in the room, counting the connections handed over that it didn't report yet.
+        """
+        return self.players + self.handoffs - self.received_handoffs
+
+    def receive_players(self) -> None:
+        try:
+            self.received_handoffs, self.players = self.connection.recv()
+            stats.set(f"players.{self.process.name}", self.players)
+        except (EOFError, OSError):
+            self.stop()
+
+    def stop(self) -> None:
+        if not self.stopped:
+            print("room", self.process.name, "stopped")
+            self.stopped = True
+            stats.set(f"players.{self.process.name}", 0)
+            loop.remove_reader(self.connection.fileno())
+
+
+async def run_lobby(listen_socket: socket.socket, rooms: List[Room]) -> None:
+    """
+    Accept the connections and hand each one over to the emptiest room that is running and not full.
+    """
+    while True:
+        client_socket, address = await loop.sock_accept(listen_socket)
+        while True:
+            open_rooms = [room for room in rooms if not room.stopped and room.load() < args.room_size]
+            if not open_rooms:
+                print(address, "rejected, all rooms are full or stopped")
+                stats.count("rejected")
+                # connections start with json, so the client understands the error before it says hello
+                try:
+                    await loop.sock_sendall(client_socket, protocol.JsonCodec().encode(
+                        {"type": "error", "error": "server full"}))
+                except OSError:
+                    pass
+                break
+            room = min(open_rooms, key=Room.load)
+            try:
+                multiprocessing.reduction.send_handle(room.connection, client_socket.fileno(), room.process.pid)
+            except OSError:
+                # the room died since it last reported its players, try the next one
+                room.stop()
+                continue
+            print(address, "joins", room.process.name)
+            stats.count("handoffs")
+            room.handoffs += 1
+            break
+        client_socket.close()
+
+
+parser = argparse.ArgumentParser(description="shooter2d server")
+parser.add_argument("--map", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps", "default.txt"),
+                    help="map to play on, a text file with # for walls or a binary map written by tilemap.py "
+                         "(default: maps/default.txt)")
+parser.add_argument("--tick-rate", type=float, default=30,
+                    help="simulation ticks per second (default: %(default)s)")
+parser.add_argument("--json-only", action="store_true",
+                    help="do not negotiate the binary wire format with clients")
+parser.add_argument("--view-distance", type=float, default=1200,
+                    help="only send players within this distance to a client (default: %(default)s)")
+parser.add_argument("--line-of-sight", action="store_true",
+                    help="only send players that are not hidden behind walls")
+parser.add_argument("--max-rewind", type=float, default=.5,
+                    help="seconds shots are rewound at most to compensate the shooter's latency (default: %(default)s)")
+parser.add_argument("--max-message-rate", type=float, default=500,
+                    help="messages per second accepted from a client, above it only positions are kept, "
+                         "0 for no limit (default: %(default)s)")
+parser.add_argument("--max-message-burst", type=float, default=100,
+                    help="messages a client may send at once above the rate (default: %(default)s)")
+parser.add_argument("--write-buffer-limit", type=int, default=0x10000,
+                    help="bytes buffered by a client's transport before its messages are queued and its snapshots "
+                         "only replaced (default: %(default)s)")
+parser.add_argument("--max-outbound-queue", type=int, default=0x40000,
+                    help="bytes queued for a client above the write buffer before it is disconnected "
+                         "(default: %(default)s)")
+parser.add_argument("--slow-client-timeout", type=float, default=5,
+                    help="seconds a client may stay above the write buffer limit before it is disconnected "
+                         "(default: %(default)s)")
+parser.add_argument("--udp", action="store_true",
+                    help="offer clients a datagram channel for positions and snapshots")
+parser.add_argument("--udp-port", type=int, default=0,
+                    help="port of the datagram channel, rooms use the following ports (default: any free port)")
+parser.add_argument("--rooms", type=int, default=0,
+                    help="run a lobby that distributes the players over this many rooms, "
+                         "each in its own worker process (default: a single room in this process)")
+parser.add_argument("--room-size", type=int, default=16,
+                    help="players per room before the lobby fills the next one (default: %(default)s)")
+parser.add_argument("--record",
+                    help="record all messages to this file to replay them with replay.py, rooms append a suffix")
+parser.add_argument("--keyframe-interval", type=float, default=5,
+                    help="seconds between two keyframes of the recording, replays can start at them "
+                         "(default: %(default)s)")
+parser.add_argument("--stats-port", type=int,
+                    help="serve the metrics as JSON over HTTP on this port, rooms use the following ports")
+parser.add_argument("--stats-file",
+                    help="append the metrics as a JSON line to this file periodically, rooms append a suffix")
+parser.add_argument("--stats-interval", type=float, default=10,
+                    help="seconds between two writes of the stats file (default: %(default)s)")
+
+args: argparse.Namespace = None
+world: World = None
 clients: Dict[str, ServerClientProtocol] = {}
-server = loop.run_until_complete(loop.create_server(ServerClientProtocol, "127.0.0.1", 5661))
+# connection to the lobby if this process runs a room for it
+lobby_connection: Optional[multiprocessing.connection.Connection] = None
+# sockets the lobby handed to this room and those of them that are still connecting
+received_handoffs = 0
+connecting_clients = 0
+datagram_endpoint: Optional[ServerDatagramProtocol] = None
+recorder: Optional[recording.Recorder] = None
+stats = metrics.Metrics()
+
+
+def main() -> None:
+    global args, world
+    args = parser.parse_args()
+
+    if args.rooms:
+        # spawn the workers so they don't inherit the event loop and the pipes of the other rooms
+        context = multiprocessing.get_context("spawn")
+        rooms = []
+        for i in range(args.rooms):
+            lobby_end, room_end = context.Pipe()
+            process = context.Process(target=run_room, args=(args, room_end, i), name=f"room-{i}", daemon=True)
+            process.start()
+            room_end.close()
+            room = Room(process, lobby_end)
+            loop.add_reader(lobby_end.fileno(), room.receive_players)
+            rooms.append(room)
+
+        listen_socket = socket.socket()
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind(("127.0.0.1", 5661))
+        listen_socket.listen(100)
+        listen_socket.setblocking(False)
+        tasks = [loop.create_task(run_lobby(listen_socket, rooms))]
+        tasks += start_instrumentation(args.stats_port, args.stats_file)
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            print("stopping lobby")
+
+        for task in tasks:
+            task.cancel()
+        listen_socket.close()
+        for room in rooms:
+            room.connection.close()
+            room.process.join(1)
+        loop.close()
+        return
+
+    world = World(tilemap.TileMap.load(args.map), history_length=math.ceil(args.max_rewind * args.tick_rate) + 1)
+    server = loop.run_until_complete(loop.create_server(ServerClientProtocol, "127.0.0.1", 5661))
+    if args.udp:
+        open_datagram_endpoint(args.udp_port)
+    if args.record:
+        start_recording(args.record)
+    tasks = [loop.create_task(run_ticks(args.tick_rate))]
+    tasks += start_instrumentation(args.stats_port, args.stats_file)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print("stopping server")
+
+    for task in tasks:
+        task.cancel()
+    if datagram_endpoint is not None:
+        datagram_endpoint.transport.close()
+    if recorder is not None:
+        recorder.close()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
 
-try:
-    loop.run_forever()
-except KeyboardInterrupt:
-    print("stopping server")
 
-server.close()
-loop.run_until_complete(server.wait_closed())
-loop.close()
+if __name__ == "__main__":
+    main()
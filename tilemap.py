@@ -0,0 +1,407 @@
+"""
+Tile maps and tile map queries shared by server and client
+
+Coordinates are in tiles, the tile (x, y) covers the square from (x, y) to (x + 1, y + 1). Everything outside the
+map is free.
+
+Maps are stored with one byte per tile. They are loaded either from text files, where ``#`` is a wall and every
+other character is free, or from binary files that are memory-mapped, so even huge maps load instantly and only the
+parts that are used are read from disk. Clients receive the map in square chunks packed with one bit per tile.
+"""
+import argparse
+import math
+import mmap
+import struct
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+FREE = 0
+WALL = 1
+
+# magic bytes, width and height in tiles, followed by one byte per tile row by row
+BINARY_HEADER = struct.Struct("<4sII")
+BINARY_MAGIC = b"S2DM"
+
+# clearance is counted up to this many tiles, walls further away don't matter for collisions
+MAX_CLEARANCE = 8
+# tiles per side of the square blocks the clearance is computed in
+CLEARANCE_BLOCK_SIZE = 32
+
+_TILE_CHARACTERS = bytes.maketrans(bytes([FREE, WALL]), b"01")
+_TILE_BYTES = bytes.maketrans(b"01", bytes([FREE, WALL]))
+
+
+class TileMap:
+    def __init__(self, width: int, height: int, tiles: Union[bytearray, memoryview, None] = None) -> None:
+        self.width = width
+        self.height = height
+        self.tiles = bytearray(width * height) if tiles is None else tiles
+        if len(self.tiles) != width * height:
+            raise ValueError(f"{len(self.tiles)} tiles for a map of {width}x{height} tiles")
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[str]) -> "TileMap":
+        width = max((len(row) for row in rows), default=0)
+        tiles = bytearray()
+        for row in rows:
+            tiles += bytes(WALL if tile == "#" else FREE for tile in row.ljust(width))
+        return cls(width, len(rows), tiles)
+
+    @classmethod
+    def load(cls, path: str) -> "TileMap":
+        with open(path, "rb") as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                f.seek(0)
+                return cls.from_rows(f.read().decode().splitlines())
+            # the mapping stays valid after the file is closed
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, height = BINARY_HEADER.unpack_from(data)
+        return cls(width, height, memoryview(data)[BINARY_HEADER.size:BINARY_HEADER.size + width * height])
+
+    def save(self, path: str) -> None:
+        """
+        Write the map in the binary format.
+        """
+        with open(path, "wb") as f:
+            f.write(BINARY_HEADER.pack(BINARY_MAGIC, self.width, self.height))
+            f.write(self.tiles)
+
+    def chunk_count(self, chunk_size: int) -> Tuple[int, int]:
+        return math.ceil(self.width / chunk_size), math.ceil(self.height / chunk_size)
+
+    def get_chunk(self, chunk_x: int, chunk_y: int, chunk_size: int) -> bytes:
+        """
+        Return the tiles of a chunk packed with one bit per tile, row by row, the most significant bit first.
+        """
+        left = chunk_x * chunk_size
+        width = max(0, min(chunk_size, self.width - left))
+        bits = []
+        for y in range(chunk_y * chunk_size, (chunk_y + 1) * chunk_size):
+            row = b""
+            if 0 <= y < self.height:
+                start = y * self.width + left
+                row = bytes(self.tiles[start:start + width]).translate(_TILE_CHARACTERS)
+            bits.append(row.ljust(chunk_size, b"0"))
+        return int(b"".join(bits), 2).to_bytes(chunk_size**2 // 8, "big")
+
+    def set_chunk(self, chunk_x: int, chunk_y: int, chunk_size: int, data: bytes) -> None:
+        """
+        Store the tiles of a chunk packed by get_chunk, the parts outside the map are ignored.
+        """
+        bits = bin(int.from_bytes(data, "big"))[2:].zfill(chunk_size**2).encode().translate(_TILE_BYTES)
+        left = chunk_x * chunk_size
+        width = max(0, min(chunk_size, self.width - left))
+        for i, y in enumerate(range(chunk_y * chunk_size, (chunk_y + 1) * chunk_size)):
+            if 0 <= y < self.height:
+                start = y * self.width + left
+                self.tiles[start:start + width] = bits[i * chunk_size:i * chunk_size + width]
+
+
+def is_wall(map: TileMap, x: int, y: int) -> bool:
+    return 0 <= x < map.width and 0 <= y < map.height and map.tiles[y * map.width + x] == WALL
+
+
+def wall_rectangles(map: TileMap, left: int, top: int, right: int, bottom: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Cover the wall tiles in the region from (left, top) to (right, bottom) with few rectangles (x, y, width, height).
+
+    Runs of walls in a row are merged with the runs of the same extent in the following rows.
+    """
+    rectangles = []
+    # open rectangles by the (start, end) of their runs in the previous row
+    open_rectangles: Dict[Tuple[int, int], List[int]] = {}
+    for y in range(top, bottom + 1):
+        runs = set()
+        if y < bottom:
+            x = left
+            while x < right:
+                if is_wall(map, x, y):
+                    start = x
+                    while x < right and is_wall(map, x, y):
+                        x += 1
+                    runs.add((start, x))
+                x += 1
+        for run in list(open_rectangles):
+            if run not in runs:
+                rectangles.append(tuple(open_rectangles.pop(run)))
+        for start, end in runs:
+            if (start, end) in open_rectangles:
+                open_rectangles[start, end][3] += 1
+            else:
+                open_rectangles[start, end] = [start, y, end - start, 1]
+    return rectangles
+
+
+def wall_edges(map: TileMap, left: int, top: int, right: int, bottom: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Return the borders between the wall tiles in the region and free tiles as segments (x1, y1, x2, y2).
+
+    Borders between two walls are left out and consecutive borders on a line are merged, so every border of the
+    walls is in the list exactly once.
+    """
+    edges = []
+    # horizontal borders above (dy = -1) and below (dy = 1) the walls
+    for dy, line_offset in ((-1, 0), (1, 1)):
+        for y in range(top, bottom):
+            start = None
+            for x in range(left, right + 1):
+                border = x < right and is_wall(map, x, y) and not is_wall(map, x, y + dy)
+                if border and start is None:
+                    start = x
+                elif not border and start is not None:
+                    edges.append((start, y + line_offset, x, y + line_offset))
+                    start = None
+    # vertical borders left (dx = -1) and right (dx = 1) of the walls
+    for dx, line_offset in ((-1, 0), (1, 1)):
+        for x in range(left, right):
+            start = None
+            for y in range(top, bottom + 1):
+                border = y < bottom and is_wall(map, x, y) and not is_wall(map, x + dx, y)
+                if border and start is None:
+                    start = y
+                elif not border and start is not None:
+                    edges.append((x + line_offset, start, x + line_offset, y))
+                    start = None
+    return edges
+
+
+def traverse(start_x: float, start_y: float, end_x: float, end_y: float) -> Iterator[Tuple[int, int]]:
+    """
+    Yield the tiles crossed by the segment from start to end in order, starting with the tile of the start point.
+    """
+    for tile_x, tile_y, _ in _crossings(start_x, start_y, end_x, end_y):
+        yield tile_x, tile_y
+
+
+def _crossings(start_x: float, start_y: float, end_x: float, end_y: float) -> Iterator[Tuple[int, int, float]]:
+    """
+    Yield the tiles crossed by the segment together with the fraction of the segment at which it enters them.
+    """
+    tile_x = math.floor(start_x)
+    tile_y = math.floor(start_y)
+    dx = end_x - start_x
+    dy = end_y - start_y
+    step_x = 1 if dx > 0 else -1
+    step_y = 1 if dy > 0 else -1
+    # distance along the segment (as a fraction of its length) between two vertical / horizontal tile borders
+    t_delta_x = abs(1 / dx) if dx else math.inf
+    t_delta_y = abs(1 / dy) if dy else math.inf
+    # distance along the segment to the next vertical / horizontal tile border
+    t_max_x = ((tile_x + 1 - start_x) if dx > 0 else (start_x - tile_x)) * t_delta_x if dx else math.inf
+    t_max_y = ((tile_y + 1 - start_y) if dy > 0 else (start_y - tile_y)) * t_delta_y if dy else math.inf
+
+    yield tile_x, tile_y, 0
+    for _ in range(abs(math.floor(end_x) - tile_x) + abs(math.floor(end_y) - tile_y)):
+        if t_max_x < t_max_y:
+            t = t_max_x
+            tile_x += step_x
+            t_max_x += t_delta_x
+        else:
+            t = t_max_y
+            tile_y += step_y
+            t_max_y += t_delta_y
+        yield tile_x, tile_y, min(t, 1)
+
+
+def raycast(map: TileMap, start_x: float, start_y: float, end_x: float, end_y: float) -> Optional[float]:
+    """
+    Return the fraction of the segment from start to end at which it enters the first wall tile, None if it does
+    not touch a wall.
+    """
+    for x, y, t in _crossings(start_x, start_y, end_x, end_y):
+        if is_wall(map, x, y):
+            return t
+    return None
+
+
+def line_of_sight(map: TileMap, start_x: float, start_y: float, end_x: float, end_y: float) -> bool:
+    """
+    Test if the segment from start to end does not touch any wall tile.
+
+    Only the tiles crossed by the segment are looked at, so the cost grows with the length of the segment and not
+    with the size of the map.
+    """
+    return not any(is_wall(map, x, y) for x, y in traverse(start_x, start_y, end_x, end_y))
+
+
+def reachable_tiles(map: TileMap, x: int, y: int, max_steps: int) -> List[Tuple[int, int]]:
+    """
+    Return the free tiles of the map that can be reached from the free tile (x, y) in at most max_steps steps to one
+    of the 4 neighbours, nearest first.
+
+    Only the tiles within max_steps of the start are looked at, so the cost doesn't grow with the size of the map.
+    """
+    steps = {(x, y): 0}
+    queue = deque([(x, y)])
+    while queue:
+        tile = queue.popleft()
+        if steps[tile] == max_steps:
+            continue
+        tile_x, tile_y = tile
+        for neighbour in ((tile_x - 1, tile_y), (tile_x + 1, tile_y), (tile_x, tile_y - 1), (tile_x, tile_y + 1)):
+            if (neighbour not in steps and 0 <= neighbour[0] < map.width and 0 <= neighbour[1] < map.height
+                    and not is_wall(map, *neighbour)):
+                steps[neighbour] = steps[tile] + 1
+                queue.append(neighbour)
+    return list(steps)
+
+
+class ClearanceField:
+    """
+    Distance of every tile to the nearest wall tile in steps to one of the 8 neighbours, 0 for walls and at most
+    MAX_CLEARANCE.
+
+    A point in a tile with clearance c is at least c - 1 tiles away from every wall. The field is computed in blocks
+    when a tile of the block is looked up the first time, so parts of huge maps nobody walks in cost nothing.
+    """
+    def __init__(self, map: TileMap) -> None:
+        self.map = map
+        self.blocks: Dict[Tuple[int, int], bytearray] = {}
+
+    def clearance(self, x: int, y: int) -> int:
+        block_x, offset_x = divmod(x, CLEARANCE_BLOCK_SIZE)
+        block_y, offset_y = divmod(y, CLEARANCE_BLOCK_SIZE)
+        block = self.blocks.get((block_x, block_y))
+        if block is None:
+            block = self.blocks[block_x, block_y] = self.compute_block(block_x, block_y)
+        return block[offset_y * CLEARANCE_BLOCK_SIZE + offset_x]
+
+    def invalidate(self, left: int, top: int, right: int, bottom: int) -> None:
+        """
+        Forget the clearance of the tiles that depends on the tiles in the region, after they changed.
+        """
+        for block_y in range((top - MAX_CLEARANCE) // CLEARANCE_BLOCK_SIZE,
+                             (bottom - 1 + MAX_CLEARANCE) // CLEARANCE_BLOCK_SIZE + 1):
+            for block_x in range((left - MAX_CLEARANCE) // CLEARANCE_BLOCK_SIZE,
+                                 (right - 1 + MAX_CLEARANCE) // CLEARANCE_BLOCK_SIZE + 1):
+                self.blocks.pop((block_x, block_y), None)
+
+    def compute_block(self, block_x: int, block_y: int) -> bytearray:
+        # walls further than MAX_CLEARANCE from the block don't matter, so the block and that margin are enough
+        size = CLEARANCE_BLOCK_SIZE + 2 * MAX_CLEARANCE
+        left = block_x * CLEARANCE_BLOCK_SIZE - MAX_CLEARANCE
+        top = block_y * CLEARANCE_BLOCK_SIZE - MAX_CLEARANCE
+        distances = bytearray(0 if is_wall(self.map, left + x, top + y) else MAX_CLEARANCE
+                              for y in range(size) for x in range(size))
+        # a forward and a backward pass over the neighbours already visited give the distance in steps
+        for y_range, x_range, direction in ((range(size), range(size), 1),
+                                            (range(size - 1, -1, -1), range(size - 1, -1, -1), -1)):
+            for y in y_range:
+                previous_row = y - direction
+                for x in x_range:
+                    i = y * size + x
+                    distance = distances[i]
+                    if not distance:
+                        continue
+                    previous_x = x - direction
+                    if 0 <= previous_x < size:
+                        distance = min(distance, distances[i - direction] + 1)
+                    if 0 <= previous_row < size:
+                        row = previous_row * size
+                        for neighbour_x in (x - 1, x, x + 1):
+                            if 0 <= neighbour_x < size:
+                                distance = min(distance, distances[row + neighbour_x] + 1)
+                    distances[i] = distance
+        block = bytearray()
+        for y in range(MAX_CLEARANCE, MAX_CLEARANCE + CLEARANCE_BLOCK_SIZE):
+            block += distances[y * size + MAX_CLEARANCE:y * size + MAX_CLEARANCE + CLEARANCE_BLOCK_SIZE]
+        return block
+
+
+def push_out(map: TileMap, x: float, y: float, radius: float) -> Optional[Tuple[float, float]]:
+    """
+    Return the position of a circle moved out of the wall tiles it overlaps, closest first, None if it overlaps none.
+    """
+    tiles = [
+        (tile_x, tile_y)
+        for tile_y in range(math.floor(y - radius), math.floor(y + radius) + 1)
+        for tile_x in range(math.floor(x - radius), math.floor(x + radius) + 1)
+        if is_wall(map, tile_x, tile_y)
+    ]
+    tiles.sort(key=lambda tile: (tile[0] + .5 - x)**2 + (tile[1] + .5 - y)**2)
+    pushed = False
+    for tile_x, tile_y in tiles:
+        nearest_x = min(max(x, tile_x), tile_x + 1)
+        nearest_y = min(max(y, tile_y), tile_y + 1)
+        distance = math.hypot(x - nearest_x, y - nearest_y)
+        # circles pushed out before touch the walls, up to rounding errors
+        if distance >= radius - 1e-9:
+            continue
+        pushed = True
+        if distance:
+            x = nearest_x + (x - nearest_x) * radius / distance
+            y = nearest_y + (y - nearest_y) * radius / distance
+        else:
+            # the center is inside the tile, leave it through the closest side that doesn't lead into a wall
+            sides = [(distance, side_x, side_y)
+                     for distance, side_x, side_y in ((x - tile_x, -1, 0), (tile_x + 1 - x, 1, 0),
+                                                      (y - tile_y, 0, -1), (tile_y + 1 - y, 0, 1))
+                     if not is_wall(map, tile_x + side_x, tile_y + side_y)]
+            if not sides:
+                continue
+            _, side_x, side_y = min(sides)
+            if side_x:
+                x = (tile_x if side_x < 0 else tile_x + 1) + side_x * radius
+            else:
+                y = (tile_y if side_y < 0 else tile_y + 1) + side_y * radius
+    return (x, y) if pushed else None
+
+
+def move_circle(field: ClearanceField, x: float, y: float, radius: float,
+                dx: float, dy: float) -> Tuple[float, float, bool]:
+    """
+    Move a circle from (x, y) by (dx, dy), sliding along the walls it runs into. Return where it ends up and whether
+    it touched a wall, if it didn't it ends up at exactly (x + dx, y + dy).
+
+    Through free space the circle moves as far as the clearance allows in one step. Close to walls it moves in steps
+    of half its radius and is pushed out of the walls after each, so it can't skip a wall however far it moves.
+    """
+    length = math.hypot(dx, dy)
+    if not length:
+        return x, y, False
+    direction_x = dx / length
+    direction_y = dy / length
+    current_x = x
+    current_y = y
+    blocked = False
+    while length > 0:
+        free = field.clearance(math.floor(current_x), math.floor(current_y)) - 1 - radius
+        if free >= length:
+            step = length
+        elif free > radius / 2:
+            step = free
+        else:
+            step = min(length, radius / 2)
+        previous_x = current_x
+        previous_y = current_y
+        current_x += step * direction_x
+        current_y += step * direction_y
+        length -= step
+        if step <= free:
+            continue
+        pushed = push_out(field.map, current_x, current_y, radius)
+        if pushed is not None:
+            blocked = True
+            if push_out(field.map, *pushed, radius) is None:
+                current_x, current_y = pushed
+            else:
+                # squeezed between walls, pushing out of one moved it into another
+                current_x = previous_x
+                current_y = previous_y
+    if not blocked:
+        return x + dx, y + dy, False
+    return current_x, current_y, True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="convert a text map to the memory-mappable binary format")
+    parser.add_argument("source", help="text map, # for walls")
+    parser.add_argument("destination", help="binary map to write")
+    args = parser.parse_args()
+    map = TileMap.load(args.source)
+    map.save(args.destination)
+    print(f"wrote {map.width}x{map.height} tiles to {args.destination}")
+
+
+if __name__ == "__main__":
+    main()
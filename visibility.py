@@ -0,0 +1,142 @@
+"""
+Visibility polygon of a point between walls
+
+The polygon is computed with an angular sweep: the end points of the wall segments are sorted by their angle around
+the point and visited in order, keeping the segments the sweep ray currently crosses sorted by distance. Whenever the
+closest segment changes, the part of the previous closest segment since the last change is added to the polygon.
+Segments must not cross each other, they may only share end points, which holds for the borders of tiles.
+"""
+import math
+from typing import Iterable, List, Optional, Tuple
+
+Point = Tuple[float, float]
+Segment = Tuple[float, float, float, float]
+
+
+def clip_segment(segment: Segment, left: float, top: float, right: float, bottom: float) -> Optional[Segment]:
+    """
+    Clip a horizontal or vertical segment to the rectangle, return None if no part of it is inside.
+    """
+    x1, y1, x2, y2 = segment
+    if x1 == x2:
+        if not left <= x1 <= right:
+            return None
+        y1, y2 = max(min(y1, y2), top), min(max(y1, y2), bottom)
+    else:
+        if not top <= y1 <= bottom:
+            return None
+        x1, x2 = max(min(x1, x2), left), min(max(x1, x2), right)
+    if (x1, y1) == (x2, y2) or x1 > x2 or y1 > y2:
+        return None
+    return x1, y1, x2, y2
+
+
+def left_of(segment: Segment, x: float, y: float) -> bool:
+    x1, y1, x2, y2 = segment
+    return (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1) < 0
+
+
+def behind(a: Segment, b: Segment) -> bool:
+    """
+    Test if segment a is behind segment b seen from the origin, for segments that don't cross.
+    """
+    ax1, ay1, ax2, ay2 = a
+    bx1, by1, bx2, by2 = b
+    # points close to the ends, so a shared end point doesn't count as being on both sides
+    a_b1 = left_of(a, bx1 + (bx2 - bx1) * .01, by1 + (by2 - by1) * .01)
+    a_b2 = left_of(a, bx2 + (bx1 - bx2) * .01, by2 + (by1 - by2) * .01)
+    a_origin = left_of(a, 0, 0)
+    b_a1 = left_of(b, ax1 + (ax2 - ax1) * .01, ay1 + (ay2 - ay1) * .01)
+    b_a2 = left_of(b, ax2 + (ax1 - ax2) * .01, ay2 + (ay1 - ay2) * .01)
+    b_origin = left_of(b, 0, 0)
+    if b_a1 == b_a2 != b_origin:
+        # a is on the other side of b than the origin
+        return True
+    if a_b1 == a_b2 == a_origin:
+        # b is on the same side of a as the origin
+        return True
+    return False
+
+
+def ray_intersection(angle: float, segment: Segment) -> Point:
+    """
+    Return the point where the ray from the origin with the given angle meets the line through the segment.
+    """
+    dx = math.cos(angle)
+    dy = math.sin(angle)
+    x1, y1, x2, y2 = segment
+    sx = x2 - x1
+    sy = y2 - y1
+    denominator = dx * sy - dy * sx
+    if not denominator:
+        return x1, y1
+    distance = (x1 * sy - y1 * sx) / denominator
+    return distance * dx, distance * dy
+
+
+def visibility_polygon(x: float, y: float, segments: Iterable[Segment],
+                       bounds: Tuple[float, float, float, float]) -> List[Point]:
+    """
+    Return the corners of the area visible from (x, y) between horizontal and vertical wall segments, limited to
+    the bounds (left, top, right, bottom) which must contain the point.
+    """
+    left, top, right, bottom = bounds
+    # the sweep works relative to the point, the bounds are walls as well so the sweep always meets a segment
+    relative_segments = [
+        (left - x, top - y, right - x, top - y),
+        (right - x, top - y, right - x, bottom - y),
+        (left - x, bottom - y, right - x, bottom - y),
+        (left - x, top - y, left - x, bottom - y),
+    ]
+    for segment in segments:
+        segment = clip_segment(segment, left, top, right, bottom)
+        if segment is None:
+            continue
+        x1, y1, x2, y2 = segment
+        x1 -= x
+        y1 -= y
+        x2 -= x
+        y2 -= y
+        if abs(x1 * y2 - y1 * x2) < 1e-9:
+            # seen edge-on, it hides nothing
+            continue
+        relative_segments.append((x1, y1, x2, y2))
+
+    # angle, whether the segment ends there and the segment, a segment begins at the end it is entered from
+    end_points: List[Tuple[float, bool, Segment]] = []
+    for segment in relative_segments:
+        x1, y1, x2, y2 = segment
+        angle1 = math.atan2(y1, x1)
+        angle2 = math.atan2(y2, x2)
+        difference = angle2 - angle1
+        if difference <= -math.pi:
+            difference += math.tau
+        elif difference > math.pi:
+            difference -= math.tau
+        end_points.append((angle1, difference < 0, segment))
+        end_points.append((angle2, difference > 0, segment))
+    # at the same angle segments begin before others end, so there is no gap between them
+    end_points.sort(key=lambda end_point: end_point[:2])
+
+    # segments crossed by the sweep ray, closest first
+    open_segments: List[Segment] = []
+    polygon: List[Point] = []
+    begin_angle = 0.
+    # segments crossing the angle of pi are only opened in the first pass, so the second one starts with them
+    for output in (False, True):
+        for angle, ends, segment in end_points:
+            closest = open_segments[0] if open_segments else None
+            if ends:
+                if segment in open_segments:
+                    open_segments.remove(segment)
+            else:
+                i = 0
+                while i < len(open_segments) and behind(segment, open_segments[i]):
+                    i += 1
+                open_segments.insert(i, segment)
+            if (open_segments[0] if open_segments else None) != closest:
+                if output and closest is not None:
+                    for point_x, point_y in (ray_intersection(begin_angle, closest), ray_intersection(angle, closest)):
+                        polygon.append((x + point_x, y + point_y))
+                begin_angle = angle
+    return polygon